@@ -19,6 +19,7 @@
         "views/mrp_routing_workcenter_inherit.xml",
         "security/frepple_security.xml",
         "security/ir.model.access.csv",
+        "views/frepple_cron.xml",
     ],
     "test": [],
     "installable": True,
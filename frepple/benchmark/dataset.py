@@ -0,0 +1,560 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Synthetic dataset for the benchmark of the frePPLe connector.
+
+The generator fills a FakeEnvironment with a manufacturing company: products
+organized in a multi-level bill of material, a location tree per warehouse,
+customers, suppliers, sales orders, purchase orders, manufacturing orders,
+reorder points and inventory.
+The data is random, but repeatable for a given seed.
+"""
+
+import random
+from datetime import timedelta
+from io import BytesIO
+from xml.sax.saxutils import quoteattr
+
+from fake_env import FakeEnvironment
+
+
+COMPANY = "Benchmark company"
+
+
+def register_models(env):
+    """
+    Register all models the connector accesses, with the relations used in
+    dotted domain paths and the types converted on create and write.
+    """
+    for name in (
+        "ir.model",
+        "res.company",
+        "res.partner",
+        "uom.uom",
+        "product.category",
+        "product.template",
+        "product.product",
+        "product.supplierinfo",
+        "stock.warehouse",
+        "stock.location",
+        "stock.quant",
+        "stock.warehouse.orderpoint",
+        "mrp.skill",
+        "mrp.workcenter",
+        "mrp.workcenter.skill",
+        "mrp.routing.workcenter",
+        "mrp.bom",
+        "mrp.bom.line",
+        "sale.order",
+        "frepple.watermark",
+        "frepple.deletion",
+    ):
+        env.register(name)
+    env.register(
+        "sale.order.line",
+        relations={"order_id": "sale.order", "product_id": "product.product"},
+    )
+    env.register("purchase.order", datetimes=("date_order",))
+    env.register(
+        "purchase.order.line",
+        relations={"order_id": "purchase.order", "product_id": "product.product"},
+        datetimes=("date_planned",),
+        floats=("product_qty",),
+    )
+    env.register(
+        "mrp.production",
+        datetimes=("date_planned_start", "date_planned_finished"),
+        floats=("product_qty",),
+    )
+
+
+def generate(
+    products=1000,
+    bom_depth=3,
+    so_lines=10000,
+    locations=200,
+    warehouses=3,
+    customers=500,
+    suppliers=100,
+    po_lines=2000,
+    mos=1000,
+    seed=1,
+):
+    """
+    Build a new environment filled with a synthetic dataset.
+    """
+    rnd = random.Random(seed)
+    env = FakeEnvironment()
+    register_models(env)
+    now = env.now
+    # All records are stamped one day in the past, so a delta export can
+    # distinguish the records touched later on.
+    env.now = now - timedelta(days=1)
+
+    def create(model, vals):
+        return env[model].create(vals).id
+
+    create("ir.model", {"model": "mrp.workorder"})
+
+    # Units of measure: 2 categories with a reference unit and a multiple
+    unit = create(
+        "uom.uom",
+        {"name": "Units", "factor": 1.0, "uom_type": "reference", "category_id": 1},
+    )
+    dozen = create(
+        "uom.uom",
+        {"name": "Dozens", "factor": 1 / 12.0, "uom_type": "bigger", "category_id": 1},
+    )
+    kg = create(
+        "uom.uom",
+        {"name": "kg", "factor": 1.0, "uom_type": "reference", "category_id": 2},
+    )
+    gram = create(
+        "uom.uom",
+        {"name": "g", "factor": 1000.0, "uom_type": "smaller", "category_id": 2},
+    )
+    uoms = {unit: (unit, dozen), kg: (kg, gram)}
+
+    # Product categories
+    categories = [
+        create("product.category", {"name": "All", "complete_name": "All"})
+    ]
+    for i in range(10):
+        categories.append(
+            create(
+                "product.category",
+                {"name": "Cat %d" % i, "complete_name": "All / Cat %d" % i},
+            )
+        )
+
+    # Partners
+    customer_ids = []
+    for i in range(customers):
+        name = "Customer %05d" % i
+        customer_ids.append(
+            create(
+                "res.partner",
+                {
+                    "name": name,
+                    "display_name": name,
+                    "is_company": True,
+                    "customer_rank": 1,
+                    "supplier_rank": 0,
+                    "active": True,
+                },
+            )
+        )
+    supplier_ids = []
+    for i in range(suppliers):
+        name = "Supplier %05d" % i
+        supplier_ids.append(
+            create(
+                "res.partner",
+                {
+                    "name": name,
+                    "display_name": name,
+                    "is_company": True,
+                    "customer_rank": 0,
+                    "supplier_rank": 1,
+                    "active": True,
+                },
+            )
+        )
+
+    # Locations: a view location and a stock location per warehouse, with
+    # the remaining locations as bins below the stock locations. As in Odoo,
+    # the complete name of a view location is its own name, and warehouses
+    # are named after their code. The manufacturing orders are created on the
+    # view location of the manufacturing warehouse, so that their operation
+    # names match the operations exported for the bills of material.
+    root = create(
+        "stock.location",
+        {"name": "Physical Locations", "complete_name": "Physical Locations", "active": True},
+    )
+    env.models["stock.location"].records[root]["parent_path"] = "%d/" % root
+    warehouse_ids = []
+    stock_locations = []
+
+    def location(name, parent, view=False):
+        parent_rec = env.models["stock.location"].records[parent]
+        id = create(
+            "stock.location",
+            {
+                "name": name,
+                "complete_name": name
+                if view
+                else "%s/%s" % (parent_rec["complete_name"], name),
+                "location_id": parent,
+                "active": True,
+            },
+        )
+        env.models["stock.location"].records[id]["parent_path"] = "%s%d/" % (
+            parent_rec["parent_path"],
+            id,
+        )
+        return id
+
+    for i in range(warehouses):
+        code = "WH%d" % i
+        view = location(code, root, view=True)
+        stock = location("Stock", view)
+        stock_locations.append(stock)
+        warehouse_ids.append(
+            create(
+                "stock.warehouse",
+                {
+                    "name": code,
+                    "code": code,
+                    "lot_stock_id": stock,
+                    "wh_input_stock_loc_id": location("Input", view),
+                    "wh_output_stock_loc_id": location("Output", view),
+                    "wh_pack_stock_loc_id": location("Packing Zone", view),
+                    "wh_qc_stock_loc_id": location("Quality Control", view),
+                    "view_location_id": view,
+                },
+            )
+        )
+    bins = []
+    for i in range(max(locations - 6 * warehouses - 1, 0)):
+        bins.append(location("Bin %05d" % i, rnd.choice(stock_locations)))
+    all_stock = stock_locations + bins
+
+    create(
+        "res.company",
+        {
+            "name": COMPANY,
+            "security_lead": 0.0,
+            "po_lead": 1.0,
+            "manufacturing_lead": 1.0,
+            "calendar": False,
+            "manufacturing_warehouse": warehouse_ids[0],
+        },
+    )
+
+    # Workcenters and skills
+    workcenter_ids = [
+        create("mrp.workcenter", {"name": "Workcenter %d" % i, "owner": False, "active": True})
+        for i in range(20)
+    ]
+    skill_ids = [create("mrp.skill", {"name": "Skill %d" % i}) for i in range(5)]
+    for w in workcenter_ids:
+        create(
+            "mrp.workcenter.skill",
+            {"workcenter": w, "skill": rnd.choice(skill_ids), "priority": 1},
+        )
+
+    # Products, split over the levels of the bill of material. The last level
+    # holds the purchased components.
+    levels = [[] for i in range(max(bom_depth, 1) + 1)]
+    product_ids = []
+    product_uom = {}
+    for i in range(products):
+        level = min(i * len(levels) // max(products, 1), len(levels) - 1)
+        reference = rnd.choice(list(uoms))
+        purchased = level == len(levels) - 1
+        tmpl = create(
+            "product.template",
+            {
+                "name": "Product %06d" % i,
+                "type": "product",
+                "purchase_ok": purchased,
+                "produce_delay": rnd.choice([0.5, 1.0, 2.0]),
+                "list_price": round(rnd.uniform(1, 500), 2),
+                "uom_id": reference,
+                "categ_id": rnd.choice(categories),
+                "active": True,
+            },
+        )
+        prod = create(
+            "product.product",
+            {
+                "name": "Product %06d" % i,
+                "code": "P%06d" % i if i % 2 else False,
+                "product_tmpl_id": tmpl,
+                "active": True,
+            },
+        )
+        levels[level].append((tmpl, prod))
+        product_ids.append(prod)
+        product_uom[prod] = uoms[reference]
+        if purchased:
+            for s in rnd.sample(supplier_ids, min(2, len(supplier_ids))):
+                create(
+                    "product.supplierinfo",
+                    {
+                        "name": s,
+                        "delay": rnd.randint(1, 30),
+                        "min_qty": float(rnd.choice([0, 10, 100])),
+                        "date_end": False,
+                        "date_start": False,
+                        "price": round(rnd.uniform(1, 100), 2),
+                        "product_tmpl_id": tmpl,
+                    },
+                )
+
+    # Routings and bills of material: every product that isn't purchased is
+    # built from components of the next level.
+    routings = 50
+    for r in range(1, routings + 1):
+        for seq in range(rnd.randint(1, 4)):
+            create(
+                "mrp.routing.workcenter",
+                {
+                    "name": "Step %d" % seq,
+                    "routing_id": r,
+                    "workcenter_id": rnd.choice(workcenter_ids),
+                    "sequence": seq * 10,
+                    "time_cycle": rnd.choice([15.0, 30.0, 60.0]),
+                    "skill": rnd.choice(skill_ids + [False] * 5),
+                    "search_mode": "PRIORITY",
+                },
+            )
+    bom_ids = []
+    for level in range(len(levels) - 1):
+        components = levels[level + 1]
+        if not components:
+            break
+        for tmpl, prod in levels[level]:
+            bom = create(
+                "mrp.bom",
+                {
+                    "product_qty": 1.0,
+                    "product_uom_id": product_uom[prod][0],
+                    "product_tmpl_id": tmpl,
+                    "routing_id": rnd.choice([False, rnd.randint(1, routings)]),
+                    "type": "normal",
+                    "active": True,
+                },
+            )
+            bom_ids.append((bom, prod))
+            for c_tmpl, c_prod in rnd.sample(components, min(4, len(components))):
+                create(
+                    "mrp.bom.line",
+                    {
+                        "bom_id": bom,
+                        "product_qty": float(rnd.randint(1, 5)),
+                        "product_uom_id": rnd.choice(product_uom[c_prod]),
+                        "product_id": c_prod,
+                        "routing_id": False,
+                    },
+                )
+
+    # Sales orders, with up to 10 lines each
+    states = ["draft", "sent", "sale", "sale", "sale", "done", "cancel"]
+    order = None
+    for i in range(so_lines):
+        if order is None or rnd.random() < 0.2:
+            date_order = now - timedelta(days=rnd.randint(-30, 60))
+            order = create(
+                "sale.order",
+                {
+                    "name": "SO%06d" % i,
+                    "state": rnd.choice(states),
+                    "partner_id": rnd.choice(customer_ids),
+                    "requested_date": False,
+                    "date_order": date_order,
+                    "commitment_date": False,
+                    "picking_policy": rnd.choice(["direct", "one"]),
+                    "warehouse_id": rnd.choice(warehouse_ids),
+                },
+            )
+            sequence = 0
+        sequence += 10
+        prod = rnd.choice(product_ids)
+        qty = float(rnd.randint(1, 100))
+        create(
+            "sale.order.line",
+            {
+                "order_id": order,
+                "sequence": sequence,
+                "product_id": prod,
+                "product_uom_qty": qty,
+                "qty_delivered": rnd.choice([0.0, 0.0, qty / 2, qty]),
+                "product_uom": rnd.choice(product_uom[prod]),
+                "state": env.models["sale.order"].records[order]["state"],
+            },
+        )
+
+    # Purchase orders
+    purchased = [p for t, p in levels[-1]] or product_ids
+    order = None
+    for i in range(po_lines):
+        if order is None or rnd.random() < 0.3:
+            order = create(
+                "purchase.order",
+                {
+                    "name": "PO%06d" % i,
+                    "company_id": 1,
+                    "partner_id": rnd.choice(supplier_ids),
+                    "state": rnd.choice(["purchase", "purchase", "done", "draft"]),
+                    "date_order": now - timedelta(days=rnd.randint(0, 30)),
+                    "origin": False,
+                },
+            )
+        prod = rnd.choice(purchased)
+        create(
+            "purchase.order.line",
+            {
+                "name": "Product line %d" % i,
+                "order_id": order,
+                "product_id": prod,
+                "product_qty": float(rnd.randint(10, 500)),
+                "qty_received": 0.0,
+                "product_uom": rnd.choice(product_uom[prod]),
+                "date_planned": now + timedelta(days=rnd.randint(1, 60)),
+                "state": "purchase",
+            },
+        )
+
+    # Manufacturing orders
+    mfg_view = env.models["stock.warehouse"].records[warehouse_ids[0]][
+        "view_location_id"
+    ]
+    for i in range(mos if bom_ids else 0):
+        bom, prod = rnd.choice(bom_ids)
+        create(
+            "mrp.production",
+            {
+                "name": "MO%06d" % i,
+                "bom_id": bom,
+                "date_start": False,
+                "date_planned_start": now + timedelta(days=rnd.randint(0, 30)),
+                "state": rnd.choice(["confirmed", "planned", "progress"]),
+                "product_qty": float(rnd.randint(1, 50)),
+                "product_uom_id": product_uom[prod][0],
+                "location_dest_id": mfg_view,
+                "product_id": prod,
+                "origin": False,
+            },
+        )
+
+    # Reorder points and inventory
+    for prod in rnd.sample(product_ids, len(product_ids) // 10):
+        create(
+            "stock.warehouse.orderpoint",
+            {
+                "warehouse_id": rnd.choice(warehouse_ids),
+                "product_id": prod,
+                "product_min_qty": 10.0,
+                "product_max_qty": 100.0,
+                "product_uom": product_uom[prod][0],
+                "qty_multiple": 1.0,
+                "active": True,
+            },
+        )
+    for prod in product_ids:
+        for loc in rnd.sample(all_stock, min(2, len(all_stock))):
+            create(
+                "stock.quant",
+                {
+                    "product_id": prod,
+                    "location_id": loc,
+                    "quantity": float(rnd.randint(0, 1000)),
+                },
+            )
+
+    env.now = now
+    return env
+
+
+def touch(env, fraction, seed=1):
+    """
+    Mark a fraction of the records as updated now, for a delta export.
+    """
+    rnd = random.Random(seed)
+    for model in (
+        "res.partner",
+        "product.template",
+        "product.product",
+        "mrp.bom",
+        "sale.order.line",
+        "purchase.order.line",
+        "mrp.production",
+        "stock.warehouse.orderpoint",
+    ):
+        records = env.models[model].records
+        for id in rnd.sample(list(records), int(len(records) * fraction)):
+            records[id]["write_date"] = env.now
+
+
+def generate_plan(env, pos=2000, mos=1000, seed=1):
+    """
+    Build a plan file, as frePPLe posts it back to Odoo, with proposed
+    purchase orders and manufacturing orders on the products of the dataset.
+    """
+    rnd = random.Random(seed)
+    supplierinfo = {}
+    for rec in env.models["product.supplierinfo"].records.values():
+        supplierinfo.setdefault(rec["product_tmpl_id"], []).append(rec["name"])
+    partners = env.models["res.partner"].records
+    templates = env.models["product.template"].records
+    purchased = []
+    for id, rec in env.models["product.product"].records.items():
+        if rec["product_tmpl_id"] in supplierinfo:
+            purchased.append((id, rec))
+    boms = [
+        (id, rec)
+        for id, rec in env.models["mrp.bom"].records.items()
+        if rec.get("active", True)
+    ]
+    variants = {
+        rec["product_tmpl_id"]: (id, rec)
+        for id, rec in env.models["product.product"].records.items()
+    }
+    location = env.models["stock.warehouse"].records[1]["lot_stock_id"]
+
+    out = ['<?xml version="1.0" encoding="UTF-8" ?>\n<plan>\n<operationplans>\n']
+    for i in range(pos if purchased else 0):
+        id, rec = rnd.choice(purchased)
+        supplier = rnd.choice(supplierinfo[rec["product_tmpl_id"]])
+        end = env.now + timedelta(days=rnd.randint(1, 90))
+        out.append(
+            '<operationplan ordertype="PO" id="%d" item=%s item_id="%d,%d" '
+            'supplier=%s quantity="%f" start="%s" end="%s"/>\n'
+            % (
+                i,
+                quoteattr(rec["name"]),
+                templates[rec["product_tmpl_id"]]["uom_id"],
+                id,
+                quoteattr("%d %s" % (supplier, partners[supplier]["name"])),
+                rnd.randint(1, 100),
+                (end - timedelta(days=7)).strftime("%Y-%m-%d %H:%M:%S"),
+                end.strftime("%Y-%m-%d %H:%M:%S"),
+            )
+        )
+    for i in range(mos if boms else 0):
+        bom, rec = rnd.choice(boms)
+        id, prod = variants[rec["product_tmpl_id"]]
+        end = env.now + timedelta(days=rnd.randint(1, 90))
+        out.append(
+            '<operationplan ordertype="MO" id="%d" item=%s item_id="%d,%d" '
+            'location_id="%d" operation=%s quantity="%f" start="%s" end="%s"/>\n'
+            % (
+                pos + i,
+                quoteattr(prod["name"]),
+                rec["product_uom_id"],
+                id,
+                location,
+                quoteattr("%d %s" % (bom, prod["name"])),
+                rnd.randint(1, 100),
+                (end - timedelta(days=2)).strftime("%Y-%m-%d %H:%M:%S"),
+                end.strftime("%Y-%m-%d %H:%M:%S"),
+            )
+        )
+    out.append("</operationplans>\n</plan>\n")
+    return BytesIO("".join(out).encode("utf-8"))
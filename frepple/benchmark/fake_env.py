@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+In-memory stand-in for the Odoo environment.
+
+It implements the part of the recordset API that the exporter and importer
+use: search with simple domains, browse, read, create, write and unlink.
+The cursor answers the few raw SQL queries of the exporter from the same
+in-memory tables.
+
+This is not an ORM: there are no computed fields, no record rules and no
+defaults. The synthetic dataset stores every field the connector reads.
+"""
+
+import re
+from contextlib import contextmanager
+from datetime import datetime
+from operator import itemgetter
+from types import SimpleNamespace
+
+
+class FakeRecordset(object):
+    """
+    A recordset: an ordered list of ids of a single model.
+    """
+
+    def __init__(self, model, ids, context=None):
+        self._model = model
+        self._ids = list(ids)
+        self._context = context or {}
+
+    @property
+    def env(self):
+        return self._model.env
+
+    @property
+    def ids(self):
+        return list(self._ids)
+
+    @property
+    def _name(self):
+        return self._model.name
+
+    @property
+    def _table(self):
+        return self._model.name.replace(".", "_")
+
+    @property
+    def _fields(self):
+        return self._model.fields
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __bool__(self):
+        return bool(self._ids)
+
+    def __iter__(self):
+        for i in self._ids:
+            yield FakeRecordset(self._model, [i], self._context)
+
+    def __getattr__(self, name):
+        if name in self._model.methods:
+            return lambda *args, **kwargs: self._model.methods[name](
+                self, *args, **kwargs
+            )
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name == "id":
+            return self._ids[0] if self._ids else False
+        if len(self._ids) != 1:
+            raise ValueError("Expected singleton: %s%s" % (self._model.name, self._ids))
+        return self._model.records[self._ids[0]].get(name, False)
+
+    def __setattr__(self, name, value):
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            self.write({name: value})
+
+    def with_context(self, *args, **kwargs):
+        context = dict(self._context)
+        if args:
+            context.update(args[0])
+        context.update(kwargs)
+        return FakeRecordset(self._model, self._ids, context)
+
+    def sudo(self, *args):
+        return self
+
+    def browse(self, ids):
+        if isinstance(ids, int):
+            ids = [ids]
+        return FakeRecordset(self._model, [i for i in ids if i], self._context)
+
+    def search(self, domain, offset=0, limit=None, order=None, count=False):
+        self.env.cr.sql_log_count += 1
+        active_test = self._context.get("active_test", True)
+        predicate = self._model.compile_domain(domain, active_test)
+        ids = [k for k, v in self._model.records.items() if predicate(v)]
+        if order:
+            keys = [o.split()[0] for o in order.split(",")]
+            ids.sort(key=lambda i: tuple(self._model.records[i].get(k) or 0 for k in keys))
+        ids = ids[offset : offset + limit if limit else None]
+        if count:
+            return len(ids)
+        return FakeRecordset(self._model, ids, self._context)
+
+    def search_count(self, domain):
+        return self.search(domain, count=True)
+
+    def read(self, fields=None, load="_classic_read"):
+        self.env.cr.sql_log_count += 1
+        result = []
+        records = self._model.records
+        for i in self._ids:
+            rec = records.get(i, None)
+            if rec is None:
+                continue
+            if fields:
+                row = {f: rec.get(f, False) for f in fields}
+            else:
+                row = dict(rec)
+            row["id"] = i
+            result.append(row)
+        return result
+
+    def create(self, vals_list):
+        self.env.cr.sql_log_count += 1
+        if isinstance(vals_list, dict):
+            vals_list = [vals_list]
+        ids = [self._model.insert(vals) for vals in vals_list]
+        return FakeRecordset(self._model, ids, self._context)
+
+    def write(self, vals):
+        self.env.cr.sql_log_count += 1
+        for i in self._ids:
+            self._model.update(i, vals)
+        return True
+
+    def unlink(self):
+        self.env.cr.sql_log_count += 1
+        for i in self._ids:
+            self._model.records.pop(i, None)
+        return True
+
+    def invalidate_cache(self, fnames=None, ids=None):
+        pass
+
+    def flush(self, fnames=None, records=None):
+        pass
+
+
+class FakeModel(object):
+    """
+    The table of a model, with the type information needed to evaluate domains
+    and to convert the values of create and write.
+    """
+
+    def __init__(
+        self, env, name, relations=None, datetimes=(), floats=(), methods=None
+    ):
+        self.env = env
+        self.name = name
+        self.methods = methods or {}
+        self.records = {}
+        self.relations = relations or {}
+        self.datetimes = set(datetimes) | {"write_date", "create_date"}
+        self.floats = set(floats)
+        self.fields = {}
+        self.sequence = 0
+
+    def convert(self, field, value):
+        if field in self.datetimes and isinstance(value, str):
+            return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+        if field in self.floats and isinstance(value, str):
+            return float(value)
+        return value
+
+    def insert(self, vals):
+        self.sequence += 1
+        now = self.env.now
+        rec = {"id": self.sequence, "create_date": now, "write_date": now}
+        rec.update({k: self.convert(k, v) for k, v in vals.items()})
+        self.records[self.sequence] = rec
+        for k in rec:
+            self.fields.setdefault(k, None)
+        return self.sequence
+
+    def update(self, id, vals):
+        rec = self.records[id]
+        rec.update({k: self.convert(k, v) for k, v in vals.items()})
+        rec["write_date"] = self.env.now
+
+    def value(self, rec, path):
+        """
+        Follow a dotted field path from a record.
+        """
+        model = self
+        fields = path.split(".")
+        for f in fields[:-1]:
+            target = model.relations.get(f, None)
+            if not target or not rec.get(f):
+                return False
+            model = self.env.models[target]
+            rec = model.records.get(rec[f], {})
+        return rec.get(fields[-1], False)
+
+    def compile_domain(self, domain, active_test=True):
+        """
+        Build a predicate for a domain in Polish notation.
+        Top-level terms are implicitly combined with a logical and.
+        """
+        stack = []
+        for term in reversed(domain):
+            if term == "|":
+                a, b = stack.pop(), stack.pop()
+                stack.append(lambda r, a=a, b=b: a(r) or b(r))
+            elif term == "&":
+                a, b = stack.pop(), stack.pop()
+                stack.append(lambda r, a=a, b=b: a(r) and b(r))
+            elif term == "!":
+                a = stack.pop()
+                stack.append(lambda r, a=a: not a(r))
+            else:
+                stack.append(self.compile_term(*term))
+        if active_test and "active" in self.fields:
+            if not any(isinstance(t, (list, tuple)) and t[0] == "active" for t in domain):
+                stack.append(lambda r: r.get("active", True))
+        return lambda r: all(p(r) for p in stack)
+
+    def compile_term(self, path, operator, value):
+        get = (lambda r: r.get(path, False)) if "." not in path else (
+            lambda r: self.value(r, path)
+        )
+        if operator == "=":
+            return lambda r: get(r) == value
+        if operator == "!=":
+            return lambda r: get(r) != value
+        if operator == "in":
+            value = set(value)
+            return lambda r: get(r) in value
+        if operator == "not in":
+            value = set(value)
+            return lambda r: get(r) not in value
+        if operator in (">", ">=", "<", "<="):
+            compare = {
+                ">": lambda a, b: a > b,
+                ">=": lambda a, b: a >= b,
+                "<": lambda a, b: a < b,
+                "<=": lambda a, b: a <= b,
+            }[operator]
+            return lambda r: get(r) not in (False, None) and compare(get(r), value)
+        raise NotImplementedError("Unsupported domain operator %s" % operator)
+
+
+class FakeCursor(object):
+    """
+    Cursor answering the raw SQL queries of the exporter.
+
+    The queries are recognized by the table they select from, and computed on
+    the in-memory tables.
+    """
+
+    def __init__(self, env, dbname="benchmark"):
+        self.env = env
+        self.dbname = dbname
+        self.sql_log_count = 0
+        self.itersize = 2000
+        self.rows = []
+        self.rowcount = -1
+        self._cnx = self
+
+    def cursor(self, name=None):
+        # Server-side cursors share the tables of the main cursor
+        return FakeCursor(self.env, self.dbname)
+
+    def execute(self, query, params=None):
+        self.sql_log_count += 1
+        if query.startswith("select 0, count(*), max(write_date) from "):
+            self.rows = self.query_fingerprint(query)
+        elif "at time zone 'utc'" in query:
+            self.rows = [(self.env.now,)]
+        elif "from res_partner" in query:
+            self.rows = self.query_customers()
+        elif "from stock_location" in query:
+            self.rows = self.query_locations(params[0])
+        elif "FROM stock_quant" in query:
+            self.rows = self.query_quants()
+        elif "from sale_order_line" in query:
+            self.rows = self.query_salesorders(query, params)
+        elif query.startswith("delete from purchase_order_line"):
+            self.rowcount = self.delete_children("purchase.order.line", params[0])
+        elif query.startswith("delete from stock_move"):
+            # The stand-in has no stock moves
+            self.rowcount = 0
+        else:
+            raise NotImplementedError("Unsupported query: %s" % query)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        self.rows = []
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    @contextmanager
+    def savepoint(self):
+        # Nothing is rolled back on errors
+        yield
+
+    def delete_children(self, model, parents):
+        records = self.env.models[model].records
+        ids = [k for k, v in records.items() if v.get("order_id") in parents]
+        for i in ids:
+            del records[i]
+        return len(ids)
+
+    def query_locations(self, parents):
+        parents = set(parents)
+        result = []
+        for id, rec in self.env.models["stock.location"].records.items():
+            if not rec.get("active", True):
+                continue
+            for p in reversed(rec["parent_path"].rstrip("/").split("/")):
+                if int(p) in parents:
+                    result.append((id, int(p)))
+                    break
+        return result
+
+    def query_fingerprint(self, query):
+        # The tables are named after their model
+        result = []
+        for i in query.split(" union all "):
+            index, table = re.match(
+                r"select (\d+), count\(\*\), max\(write_date\) from (\w+)$", i
+            ).groups()
+            records = self.env.models[table.replace("_", ".")].records.values()
+            result.append(
+                (
+                    int(index),
+                    len(records),
+                    max((rec["write_date"] for rec in records), default=None),
+                )
+            )
+        return result
+
+    def query_customers(self):
+        count = 0
+        last = None
+        for rec in self.env.models["res.partner"].records.values():
+            if rec["is_company"] and rec["customer_rank"] > 0 and rec["active"]:
+                count += 1
+                if not last or rec["write_date"] > last:
+                    last = rec["write_date"]
+        return [(count, last)]
+
+    def query_quants(self):
+        totals = {}
+        for rec in self.env.models["stock.quant"].records.values():
+            if rec["quantity"] > 0:
+                key = (rec["product_id"], rec["location_id"])
+                totals[key] = totals.get(key, 0) + rec["quantity"]
+        return sorted(
+            [(k[0], k[1], v) for k, v in totals.items()], key=itemgetter(1)
+        )
+
+    def query_salesorders(self, query, params):
+        orders = self.env.models["sale.order"].records
+        warehouses = self.env.models["stock.warehouse"].records
+        page = None
+        if "limit" in query:
+            # Page of a paginated export
+            page = params[-2:]
+            params = params[:-2]
+        since = params[0] if params else None
+        result = []
+        for id, line in self.env.models["sale.order.line"].records.items():
+            if not line.get("product_id"):
+                continue
+            so = orders[line["order_id"]]
+            if since and not (
+                line["write_date"] > since
+                or line["create_date"] > since
+                or so["write_date"] > since
+                or so["create_date"] > since
+            ):
+                continue
+            wh = warehouses.get(so.get("warehouse_id"), None)
+            result.append(
+                (
+                    id,
+                    line["product_id"],
+                    line["product_uom_qty"],
+                    line["qty_delivered"],
+                    line["product_uom"],
+                    so["name"],
+                    so["state"],
+                    so["partner_id"],
+                    so["date_order"],
+                    so["picking_policy"],
+                    wh["name"] if wh else None,
+                    so.get("requested_date", None),
+                    line["order_id"],
+                    line.get("sequence", 0),
+                )
+            )
+        if page:
+            result = sorted(r for r in result if r[0] > page[0])[: page[1]]
+        else:
+            result.sort(key=lambda r: (r[12], r[13], r[0]))
+        return [r[:12] for r in result]
+
+
+def get_param(recs, key, default=False):
+    for rec in recs._model.records.values():
+        if rec.get("key") == key:
+            return rec.get("value", default)
+    return default
+
+
+def get_cached(recs, key, fingerprint, loader):
+    # Like the frepple.cache model, a single value per key
+    data = recs.env.cache.get(key, None)
+    if data is None or data[0] != fingerprint:
+        data = recs.env.cache[key] = (fingerprint, loader())
+    return data[1]
+
+
+def get_generation(recs):
+    return recs.env.cache_generation
+
+
+class FakeEnvironment(object):
+    """
+    Environment holding the tables of all models and a single cursor.
+    Models that aren't registered raise a KeyError, just like in Odoo.
+    """
+
+    def __init__(self, uid=1, context=None):
+        self.uid = uid
+        self.context = context or {}
+        self.now = datetime.utcnow().replace(microsecond=0)
+        self.models = {}
+        self.cache = {}
+        self.cr = FakeCursor(self)
+        self.register("ir.config_parameter", methods={"get_param": get_param})
+        self.cache_generation = 0
+        self.register(
+            "frepple.cache",
+            methods={"get": get_cached, "get_generation": get_generation},
+        )
+
+    def register(self, name, relations=None, datetimes=(), floats=(), methods=None):
+        self.models[name] = FakeModel(
+            self, name, relations, datetimes, floats, methods
+        )
+        return self.models[name]
+
+    def __getitem__(self, name):
+        return FakeRecordset(self.models[name], [], dict(self.context))
+
+    def __contains__(self, name):
+        return name in self.models
+
+    @property
+    def companies(self):
+        model = self.models["res.company"]
+        return FakeRecordset(model, list(model.records), dict(self.context))
+
+    def invalidate_all(self):
+        pass
+
+    def clear(self):
+        pass
+
+
+class FakeRequest(object):
+    """
+    Request object with the attributes the exporter and importer access.
+    """
+
+    def __init__(self, env, files=None):
+        self.env = env
+        self.httprequest = SimpleNamespace(files=files or {})
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Benchmark of the frePPLe connector.
+
+The exporter and importer run against an in-memory stand-in for the Odoo
+environment, filled with a synthetic dataset. No Odoo server or database is
+needed, so the numbers measure the Python code of the connector and catch
+performance regressions. They don't include the time spent in PostgreSQL.
+
+Usage:
+  python3 frepple/benchmark/run.py --products 5000 --so-lines 50000
+
+Per export section, the report shows the time, rows read, rows/s, megabytes
+generated, MB/s, queries, the growth of the peak RSS and, with --trace-memory,
+the peak Python heap usage. The benchmark fails when a section doesn't output
+any rows, since it then doesn't measure that section.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import re
+import sys
+import time
+import tracemalloc
+import types
+from datetime import timedelta
+
+from dataset import COMPANY, generate, generate_plan, touch
+from fake_env import FakeRequest
+
+# Comments and the opening and closing tags of a section, which don't count
+# as output rows
+WRAPPER = re.compile(r"\s*(</?\w+>|<!--.*-->)\s*$", re.S)
+
+
+def load_connector():
+    """
+    Load the exporter and importer modules from their files, without importing
+    the frepple addon package itself.
+    """
+    try:
+        import odoo  # noqa: F401
+    except ImportError:
+        # The connector imports odoo at the top of its modules. The benchmark
+        # never reaches the code using it, so an empty module suffices.
+        sys.modules["odoo"] = types.ModuleType("odoo")
+    controllers = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "controllers"
+    )
+    modules = []
+    for name in ("outbound", "inbound"):
+        spec = importlib.util.spec_from_file_location(
+            "frepple_benchmark_%s" % name, os.path.join(controllers, "%s.py" % name)
+        )
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        modules.append(module)
+    return modules[0].exporter, modules[1].importer
+
+
+def benchmark_export(exporter, env, mode, trace_memory, sections=None):
+    """
+    Run an export and return the statistics of each section, including the
+    number of rows it outputs.
+    """
+
+    class tracing_exporter(exporter):
+        def instrument(self, section, generator):
+            if trace_memory:
+                tracemalloc.reset_peak()
+                start = tracemalloc.get_traced_memory()[0]
+            output = 0
+            for i in exporter.instrument(self, section, generator):
+                if not WRAPPER.match(i):
+                    output += 1
+                yield i
+            self.stats[-1]["output"] = output
+            if trace_memory:
+                self.stats[-1]["heap"] = (
+                    tracemalloc.get_traced_memory()[1] - start
+                ) // 1024
+
+    xp = tracing_exporter(
+        FakeRequest(env),
+        uid=env.uid,
+        database="benchmark",
+        company=COMPANY,
+        mode=mode,
+        sections=sections,
+    )
+    for i in xp.run():
+        pass
+    return xp.stats
+
+
+def benchmark_import(importer, env, plan, trace_memory):
+    """
+    Run an import and return its statistics.
+    """
+    company = env["res.company"].search([("name", "=", COMPANY)])
+    req = FakeRequest(env, files={"frePPLe plan": plan})
+    if trace_memory:
+        tracemalloc.reset_peak()
+        heap = tracemalloc.get_traced_memory()[0]
+    queries = env.cr.sql_log_count
+    start = time.perf_counter()
+    msg = importer(req, database="benchmark", company=company, mode=1).run()
+    stats = {
+        "section": "import",
+        "time": round(time.perf_counter() - start, 3),
+        "rows": sum(
+            int(i.split()[1]) for i in msg.split("\n") if i.startswith("Processed")
+        ),
+        "bytes": len(plan.getvalue()),
+        "queries": env.cr.sql_log_count - queries,
+        "memory": 0,
+    }
+    if trace_memory:
+        stats["heap"] = (tracemalloc.get_traced_memory()[1] - heap) // 1024
+    return stats
+
+
+def report(title, stats):
+    print(title)
+    print(
+        "%-22s %9s %9s %11s %9s %9s %9s %11s %11s"
+        % (
+            "section",
+            "time(s)",
+            "rows",
+            "rows/s",
+            "MB",
+            "MB/s",
+            "queries",
+            "maxrss(kB)",
+            "heap(kB)",
+        )
+    )
+    total = {
+        "section": "total",
+        "time": sum(s["time"] for s in stats),
+        "rows": sum(s["rows"] for s in stats),
+        "bytes": sum(s["bytes"] for s in stats),
+        "queries": sum(s["queries"] for s in stats),
+        "memory": sum(s.get("memory", 0) for s in stats),
+    }
+    if any("heap" in s for s in stats):
+        total["heap"] = max(s.get("heap", 0) for s in stats)
+    for s in stats + [total]:
+        mb = s["bytes"] / 1048576.0
+        print(
+            "%-22s %9.3f %9d %11.0f %9.2f %9.2f %9d %11d %11s"
+            % (
+                s["section"],
+                s["time"],
+                s["rows"],
+                s["rows"] / s["time"] if s["time"] else 0,
+                mb,
+                mb / s["time"] if s["time"] else 0,
+                s["queries"],
+                s.get("memory", 0),
+                s.get("heap", "-"),
+            )
+        )
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the frePPLe connector on a synthetic dataset"
+    )
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--bom-depth", type=int, default=3)
+    parser.add_argument("--so-lines", type=int, default=10000)
+    parser.add_argument("--locations", type=int, default=200)
+    parser.add_argument("--warehouses", type=int, default=3)
+    parser.add_argument("--customers", type=int, default=500)
+    parser.add_argument("--suppliers", type=int, default=100)
+    parser.add_argument("--po-lines", type=int, default=2000)
+    parser.add_argument("--mos", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--modes",
+        default="1,2,3",
+        help="comma separated list of export modes to run (default: 1,2,3)",
+    )
+    parser.add_argument(
+        "--sections",
+        help="comma separated list of sections to export (default: all)",
+    )
+    parser.add_argument(
+        "--delta",
+        type=float,
+        default=0.05,
+        help="fraction of the records updated before a mode 3 export (default: 0.05)",
+    )
+    parser.add_argument(
+        "--sql-salesorders",
+        action="store_true",
+        help="read the sales orders with SQL instead of the ORM",
+    )
+    parser.add_argument("--no-import", action="store_true", help="skip the import")
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="report the peak Python heap usage per section (slower)",
+    )
+    parser.add_argument("--json", help="also write the statistics to this file")
+    args = parser.parse_args()
+
+    exporter, importer = load_connector()
+
+    start = time.perf_counter()
+    env = generate(
+        products=args.products,
+        bom_depth=args.bom_depth,
+        so_lines=args.so_lines,
+        locations=args.locations,
+        warehouses=args.warehouses,
+        customers=args.customers,
+        suppliers=args.suppliers,
+        po_lines=args.po_lines,
+        mos=args.mos,
+        seed=args.seed,
+    )
+    if args.sql_salesorders:
+        env["ir.config_parameter"].create(
+            {"key": "frepple.sql_salesorders", "value": "True"}
+        )
+    print(
+        "Generated dataset in %.1f seconds: %s\n"
+        % (
+            time.perf_counter() - start,
+            ", ".join(
+                "%d %s" % (len(m.records), name)
+                for name, m in sorted(env.models.items())
+                if m.records
+            ),
+        )
+    )
+
+    if args.trace_memory:
+        tracemalloc.start()
+    results = {}
+    empty = []
+    for mode in [int(i) for i in args.modes.split(",") if i]:
+        if mode == 3:
+            # Watermarks of a previous export, before the updates of the records
+            touch(env, args.delta, args.seed)
+            company = env["res.company"].search([("name", "=", COMPANY)]).id
+            env["frepple.watermark"].create(
+                [
+                    {
+                        "company_id": company,
+                        "section": section,
+                        "date": env.now - timedelta(hours=1),
+                    }
+                    for section in (
+                        "customers",
+                        "suppliers",
+                        "items",
+                        "boms",
+                        "salesorders",
+                        "purchaseorders",
+                        "manufacturingorders",
+                        "orderpoints",
+                    )
+                ]
+            )
+        stats = benchmark_export(
+            exporter,
+            env,
+            mode,
+            args.trace_memory,
+            args.sections.split(",") if args.sections else None,
+        )
+        results["export mode %d" % mode] = stats
+        report("Export mode %d" % mode, stats)
+        # A section without output doesn't measure anything, which is a bug
+        # in the dataset
+        empty.extend(
+            "%s in export mode %d" % (s["section"], mode)
+            for s in stats
+            if not s["output"]
+        )
+    if not args.no_import:
+        plan = generate_plan(env, pos=args.po_lines, mos=args.mos, seed=args.seed)
+        stats = [benchmark_import(importer, env, plan, args.trace_memory)]
+        results["import"] = stats
+        report("Import", stats)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if empty:
+        sys.exit("No rows exported for: %s" % ", ".join(empty))
+
+
+if __name__ == "__main__":
+    main()
@@ -17,14 +17,22 @@
 #
 
 import base64
+import gzip
+import hashlib
+import json
 import logging
+import os
+import time
+import zlib
 import odoo
 from werkzeug.exceptions import MethodNotAllowed, InternalServerError
+from werkzeug.http import http_date
 from werkzeug.wrappers import Response
+from werkzeug.wsgi import wrap_file
 
 from odoo.addons.web.controllers.main import db_monodb, ensure_db
 
-from odoo.addons.frepple.controllers.outbound import exporter
+from odoo.addons.frepple.controllers.outbound import buffered, exporter
 from odoo.addons.frepple.controllers.inbound import importer
 
 try:
@@ -37,6 +45,161 @@ except Exception:
 
 logger = logging.getLogger(__name__)
 
+# Advisory locks coordinating identical exports running at the same time. The
+# first key is held by the request generating the export, the second one is
+# shared by the requests following it.
+LOCK_GENERATE = 1
+LOCK_FOLLOW = 2
+
+# Marker ending the file of an export once it is complete. The followers don't
+# pass it on to their client.
+COMPLETE = b"<!-- frePPLe export complete -->\n"
+
+
+def compress(chunks, encoding):
+    """
+    Compress a stream of chunks incrementally, while they are generated.
+
+    Supported encodings are "gzip" and "deflate" (ie the zlib format).
+    """
+    compressor = zlib.compressobj(
+        6, zlib.DEFLATED, zlib.MAX_WBITS | 16 if encoding == "gzip" else zlib.MAX_WBITS
+    )
+    try:
+        for i in chunks:
+            data = compressor.compress(i)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        chunks.close()
+
+
+def decompress(f, size=65536):
+    """
+    Read a gzip compressed file in chunks of uncompressed data.
+    """
+    try:
+        with gzip.GzipFile(fileobj=f) as data:
+            while True:
+                chunk = data.read(size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        f.close()
+
+
+def acknowledged(chunks, callback):
+    """
+    Pass on a stream of chunks, and call the callback once the web server has
+    asked for more data after the last chunk, ie once it has sent all of them.
+
+    When the client disconnects halfway, the web server closes the stream
+    instead, and the callback isn't called. It runs in its own environment,
+    since the request is finished by then.
+    """
+    try:
+        for i in chunks:
+            yield i
+    finally:
+        chunks.close()
+    try:
+        with odoo.api.Environment.manage():
+            callback()
+    except Exception:
+        logger.exception("Error acknowledging the data sent to frePPLe")
+
+
+def aborted(e):
+    return ("<!-- Export aborted: %s -->\n" % str(e).replace("--", "- -")).encode(
+        "utf-8"
+    )
+
+
+def spool(chunks, path, cr, key):
+    """
+    Pass on a stream of chunks, while also writing them to a file that other
+    requests follow.
+
+    The COMPLETE marker is appended to the file when the stream is complete,
+    and the file is removed at the end. When the client disconnects halfway,
+    the stream is still completed for the requests following it. Without
+    followers it is abandoned, just like an export that isn't shared.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        # Leftover of a process that died
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    f = open(path, "xb")
+    complete = False
+    try:
+        for i in chunks:
+            f.write(i)
+            yield i
+        complete = True
+    finally:
+        try:
+            if not complete:
+                cr.execute(
+                    "select pg_try_advisory_xact_lock(hashtext(%s), %s)",
+                    (key, LOCK_FOLLOW),
+                )
+                if not cr.fetchone()[0]:
+                    for i in chunks:
+                        f.write(i)
+                    complete = True
+            if complete:
+                f.write(COMPLETE)
+        finally:
+            chunks.close()
+            f.close()
+            os.unlink(path)
+
+
+def follow(f, cr, key, size=65536, interval=0.1):
+    """
+    Read the file of an export generated by another request, while it grows.
+
+    The export is complete only when the file ends with the COMPLETE marker.
+    The last bytes read are held back until it is known whether they are the
+    marker. Once the file is removed or the generating request has released
+    its lock, no more data will come. The file is then read to its end, and
+    a file without the marker holds an interrupted export.
+    """
+    pending = b""
+    try:
+        while True:
+            chunk = f.read(size)
+            if chunk:
+                pending += chunk
+                if len(pending) > len(COMPLETE):
+                    yield pending[: -len(COMPLETE)]
+                    pending = pending[-len(COMPLETE) :]
+                continue
+            if os.fstat(f.fileno()).st_nlink:
+                cr.execute(
+                    "select pg_try_advisory_xact_lock(hashtext(%s), %s)",
+                    (key, LOCK_GENERATE),
+                )
+                if not cr.fetchone()[0]:
+                    time.sleep(interval)
+                    continue
+            # The generating request is done, read what it wrote last
+            pending += f.read()
+            break
+        if pending.endswith(COMPLETE):
+            if len(pending) > len(COMPLETE):
+                yield pending[: -len(COMPLETE)]
+        else:
+            if pending:
+                yield pending
+            yield aborted("the request generating the export was interrupted")
+    finally:
+        f.close()
+
 
 class XMLController(odoo.http.Controller):
     def authenticate(self, req, database, language=None):
@@ -61,6 +224,402 @@ class XMLController(odoo.http.Controller):
             req.session.context["lang"] = language
         return uid
 
+    def cursor(self, database):
+        """
+        Open the cursor of an export.
+
+        The export runs in a read-only repeatable read transaction. All sections
+        see the same snapshot of the database, even though reading them takes a
+        while, and the export never blocks users updating it.
+
+        When the frepple_replica option of the Odoo configuration file holds the
+        URI of a read replica of the database, the export reads from the replica
+        and leaves the primary alone. The database name in the URI must be the
+        same as on the primary.
+        """
+        cr = None
+        replica = odoo.tools.config.get("frepple_replica", None)
+        if replica:
+            try:
+                cr = odoo.sql_db.db_connect(replica, allow_uri=True).cursor()
+                if cr.dbname != database:
+                    cr.close()
+                    cr = None
+            except Exception:
+                logger.exception("Can't connect to the frePPLe replica database")
+                cr = None
+        if not cr:
+            cr = odoo.registry(database).cursor()
+        cr.execute("set transaction isolation level repeatable read, read only")
+        return cr
+
+    def generate(
+        self, env, uid, database, company, mode, statistics, sections, exports=None
+    ):
+        """
+        Generator producing the XML export as utf-8 encoded chunks of 64kB.
+
+        An error halfway the export can't be reported with an HTTP status any
+        longer. It is logged, reported in an XML comment, and the closing plan
+        tag is not sent. FrePPLe will then reject the incomplete document
+        rather than silently loading a partial plan.
+
+        A complete export is appended to the exports list, so the caller can
+        save its watermarks once the data has been delivered.
+        """
+        try:
+            xp = exporter(
+                None,
+                uid=uid,
+                database=database,
+                company=company,
+                mode=mode,
+                env=env,
+                statistics=statistics,
+                sections=sections,
+            )
+            output = buffered(xp.run())
+            for i in output:
+                yield i
+            logger.info(
+                "frePPLe export sent %d bytes in %d chunks, from %d fragments"
+                % (output.bytes, output.chunk_count, output.fragment_count)
+            )
+            if exports is not None:
+                exports.append(xp)
+        except Exception as e:
+            logger.exception("Error generating frePPLe XML data")
+            yield aborted(e)
+
+    def fingerprint(self, req, database, uid, company, mode, statistics, sections):
+        """
+        Return the fingerprint of an export, which is sent as its ETag.
+
+        It is computed on a cursor of the database the export reads from, ie
+        the read replica when one is configured. It doesn't load the primary
+        database, and the export opens its own cursor afterwards: the data sent
+        is never older than its tag, even when the replica lags behind. When
+        the replica can't be reached, the export may still find it later, and
+        no tag is sent.
+        """
+        with odoo.api.Environment.manage():
+            cr = self.cursor(database)
+            try:
+                if odoo.tools.config.get("frepple_replica", None):
+                    cr.execute("select pg_is_in_recovery()")
+                    if not cr.fetchone()[0]:
+                        return None
+                env = odoo.api.Environment(cr, uid, dict(req.session.context))
+                return exporter(
+                    None,
+                    uid,
+                    database,
+                    company=company,
+                    mode=mode,
+                    env=env,
+                    statistics=statistics,
+                    sections=sections,
+                ).fingerprint()
+            finally:
+                cr.rollback()
+                cr.close()
+
+    def stream(
+        self,
+        database,
+        uid,
+        context,
+        company=None,
+        mode=1,
+        statistics=False,
+        sections=None,
+        exports=None,
+    ):
+        """
+        Generator sending the XML export as utf-8 encoded chunks.
+
+        The cursor is opened and closed by the generator itself. It is always
+        rolled back, since an export never updates the database. The exporter
+        of a complete export is appended to the exports list. The caller saves
+        its watermarks, in a separate transaction on the primary database, once
+        the data has been delivered.
+
+        Identical requests arriving while an export is being generated, for
+        instance a retry of frePPLe after a timeout, don't start another one.
+        The first request takes an advisory lock and writes the data to a spool
+        file in the filestore while sending it. The other requests send the
+        content of that file as it grows, and get exactly the same data. Only
+        the request generating the export saves its watermarks.
+        """
+        with odoo.api.Environment.manage():
+            cr = self.cursor(database)
+            try:
+                env = odoo.api.Environment(cr, uid, context)
+                key = "frepple.export:%s:%s:%s:%s:%s:%s" % (
+                    uid,
+                    company,
+                    mode,
+                    statistics,
+                    context.get("lang", None),
+                    ",".join(sections or []),
+                )
+                path = os.path.join(
+                    odoo.tools.config.filestore(database),
+                    "frepple",
+                    "exports",
+                    "%s.xml" % hashlib.sha1(key.encode("utf-8")).hexdigest(),
+                )
+                while True:
+                    cr.execute(
+                        "select pg_try_advisory_xact_lock(hashtext(%s), %s)",
+                        (key, LOCK_GENERATE),
+                    )
+                    if cr.fetchone()[0]:
+                        chunks = spool(
+                            self.generate(
+                                env,
+                                uid,
+                                database,
+                                company,
+                                mode,
+                                statistics,
+                                sections,
+                                exports,
+                            ),
+                            path,
+                            cr,
+                            key,
+                        )
+                        break
+                    # Another request is generating the same export
+                    cr.execute(
+                        "select pg_advisory_xact_lock_shared(hashtext(%s), %s)",
+                        (key, LOCK_FOLLOW),
+                    )
+                    try:
+                        chunks = follow(open(path, "rb"), cr, key)
+                        break
+                    except FileNotFoundError:
+                        # The export has only just started or finished
+                        time.sleep(0.1)
+                yield from chunks
+            except Exception as e:
+                logger.exception("Error generating frePPLe XML data")
+                yield aborted(e)
+            finally:
+                cr.rollback()
+                cr.close()
+
+    def page(
+        self, req, database, uid, company, mode, statistics, sections, token, size
+    ):
+        """
+        Send a single page of a paginated export.
+
+        The page is generated completely before it is sent: it is small, and the
+        continuation token can only be computed at the end. The token is sent in
+        the X-frePPLe-Next-Page header. It is opaque to the client, which passes
+        it back as the page argument to get the next page. Asking a page again
+        returns the same records, so the client can retry after an error without
+        starting the whole export over.
+
+        The watermarks are saved when the client asks the page after the last
+        one, which returns an empty plan and no token.
+        """
+        if token == "start":
+            page = {}
+        else:
+            try:
+                page = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+                if not isinstance(page, dict):
+                    raise ValueError("Invalid page %r" % (page,))
+            except Exception:
+                return Response("Invalid page argument", 400)
+            if (
+                page.pop("mode", None) != mode
+                or page.pop("company", None) != company
+                or page.pop("sections", None) != sections
+            ):
+                return Response("Page argument of another export", 400)
+        with odoo.api.Environment.manage():
+            cr = self.cursor(database)
+            try:
+                env = odoo.api.Environment(cr, uid, dict(req.session.context))
+                xp = exporter(
+                    None,
+                    uid=uid,
+                    database=database,
+                    company=company,
+                    mode=mode,
+                    env=env,
+                    statistics=statistics,
+                    page=page,
+                    sections=sections,
+                )
+                try:
+                    xp.check_page()
+                except ValueError:
+                    return Response("Invalid page argument", 400)
+                if size:
+                    xp.page_size = size
+                data = b"".join(buffered(xp.run()))
+                xp.save_watermarks()
+            except Exception:
+                logger.exception("Error generating frePPLe XML data")
+                raise InternalServerError(
+                    description="Error generating frePPLe XML data: check the Odoo log file for more details"
+                )
+            finally:
+                cr.rollback()
+                cr.close()
+        headers = [
+            ("Content-Type", "application/xml;charset=utf8"),
+            ("Cache-Control", "no-cache, no-store, must-revalidate"),
+            ("Pragma", "no-cache"),
+            ("Expires", "0"),
+            ("Vary", "Accept-Encoding"),
+        ]
+        if xp.next_page is not None:
+            xp.next_page.update(
+                {"mode": mode, "company": company, "sections": sections}
+            )
+            headers.append(
+                (
+                    "X-frePPLe-Next-Page",
+                    base64.urlsafe_b64encode(
+                        json.dumps(xp.next_page).encode("utf-8")
+                    ).decode("ascii"),
+                )
+            )
+        encoding = req.httprequest.accept_encodings.best_match(["gzip", "deflate"])
+        if encoding:
+            data = compress((i for i in (data,)), encoding)
+            headers.append(("Content-Encoding", encoding))
+        return Response(data, headers=headers, direct_passthrough=True)
+
+    def snapshot(self, req, database, uid, company_name, mode):
+        """
+        Send the latest snapshot of an export, as generated by the scheduled job.
+
+        The file is already gzip compressed. Clients accepting gzip get the file
+        as it is, without compressing it again. Other clients get it
+        decompressed on the fly.
+
+        A snapshot is only sent to the user it was generated as, ie the frePPLe
+        user of the company. It is acknowledged once it has been sent
+        completely.
+        """
+        # The company must be accessible to the user
+        m = req.env["res.company"]
+        company = m.search([("name", "=", company_name)], limit=1)
+        if not company:
+            return Response("Invalid company name argument", 401)
+        m = req.env["frepple.snapshot"].sudo()
+        snapshot = m.search(
+            [
+                ("company_id", "=", company.id),
+                ("mode", "=", mode),
+                ("user_id", "=", uid),
+            ],
+            limit=1,
+        )
+        if not snapshot:
+            return Response("No snapshot available", 404)
+        try:
+            f = open(snapshot.get_path(company.id, mode), "rb")
+        except OSError:
+            return Response("No snapshot available", 404)
+        headers = [
+            ("Content-Type", "application/xml;charset=utf8"),
+            ("Cache-Control", "no-cache, no-store, must-revalidate"),
+            ("Pragma", "no-cache"),
+            ("Expires", "0"),
+            ("Vary", "Accept-Encoding"),
+            ("Last-Modified", http_date(snapshot.date)),
+        ]
+        encoding = req.httprequest.accept_encodings.best_match(["gzip", "deflate"])
+        if encoding == "gzip":
+            data = wrap_file(req.httprequest.environ, f, buffer_size=65536)
+            headers.append(("Content-Encoding", "gzip"))
+            headers.append(("Content-Length", str(os.fstat(f.fileno()).st_size)))
+        elif encoding:
+            data = compress(decompress(f), encoding)
+            headers.append(("Content-Encoding", encoding))
+        else:
+            data = decompress(f)
+
+        def acknowledge():
+            with odoo.registry(database).cursor() as cr:
+                env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})
+                env["frepple.snapshot"].browse(snapshot.id).acknowledge()
+
+        data = acknowledged(data, acknowledge)
+        return Response(data, headers=headers, direct_passthrough=True)
+
+    def queue_import(self, req, company):
+        """
+        Store the posted plan in the filestore and queue a job importing it.
+
+        The job is committed right away, so the scheduled action importing the
+        queued plans can pick it up at its next run.
+        """
+        datafile = req.httprequest.files.get("frePPLe plan")
+        if not datafile:
+            raise Exception("No plan file posted")
+        jobs = req.env["frepple.import.job"].sudo()
+        job = jobs.create(
+            {
+                "company_id": company.id,
+                "user_id": req.env.uid,
+                "mode": int(req.httprequest.form.get("mode", 1)),
+                "state": "running",
+            }
+        )
+        path = jobs.get_path(job.id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        datafile.save(path)
+        # The job is only queued once its file is complete
+        job.write({"state": "queued"})
+        req.env.cr.commit()
+        return job
+
+    @odoo.http.route(
+        "/frepple/import/status", type="http", auth="none", methods=["GET"], csrf=False
+    )
+    def import_status(self, **kwargs):
+        """
+        Report the progress of an import queued with the async argument:
+        the records processed per order type, the errors and the elapsed time.
+        """
+        req = odoo.http.request
+        database = kwargs.get("database", None)
+        req.session.db = database
+        try:
+            uid = self.authenticate(req, database)
+        except Exception as e:
+            logger.warning("Failed login attempt: %s" % e)
+            return Response(
+                "Login with Odoo user name and password",
+                401,
+                headers=[("WWW-Authenticate", 'Basic realm="odoo"')],
+            )
+        try:
+            job_id = int(kwargs.get("job", None))
+        except (TypeError, ValueError):
+            return Response("Invalid job argument", 400)
+        job = req.env["frepple.import.job"].sudo().browse(job_id).exists()
+        if not job or job.user_id.id != uid:
+            return Response("Unknown job", 404)
+        return req.make_response(
+            json.dumps(job.get_status()),
+            [
+                ("Content-Type", "application/json"),
+                ("Cache-Control", "no-cache, no-store, must-revalidate"),
+                ("Pragma", "no-cache"),
+                ("Expires", "0"),
+            ],
+        )
+
     @odoo.http.route(
         "/frepple/xml", type="http", auth="none", methods=["POST", "GET"], csrf=False
     )
@@ -87,31 +646,114 @@ class XMLController(odoo.http.Controller):
             # to the request. It allows use to verify that the request is generated
             # from frePPLe and not from somebody else.
 
-            # Generate data
-            try:
-                xp = exporter(
+            # Serve the snapshot generated in advance, without waiting for a new
+            # export.
+            if kwargs.get("snapshot", None) == "latest":
+                return self.snapshot(
                     req,
-                    uid=uid,
-                    database=database,
-                    company=kwargs.get("company", None),
-                    mode=int(kwargs.get("mode", 1)),
+                    database,
+                    uid,
+                    kwargs.get("company", None),
+                    int(kwargs.get("mode", 1)),
                 )
-                # TODO Returning an iterator to stream the response back to the client and
-                # to save memory on the server side
-                return req.make_response(
-                    "".join([i for i in xp.run()]),
-                    headers=[
-                        ("Content-Type", "application/xml;charset=utf8"),
-                        ("Cache-Control", "no-cache, no-store, must-revalidate"),
-                        ("Pragma", "no-cache"),
-                        ("Expires", "0"),
-                    ],
+
+            company = kwargs.get("company", None)
+            mode = int(kwargs.get("mode", 1))
+            statistics = kwargs.get("statistics", "0").lower() in ("1", "true")
+
+            # The export can be limited to a comma separated list of sections
+            sections = None
+            if kwargs.get("sections", None):
+                sections = kwargs["sections"].split(",")
+                valid = exporter(req, uid, database, mode=mode).get_sections()
+                if any(i not in valid for i in sections):
+                    return Response(
+                        "Invalid sections argument: valid sections are %s"
+                        % ",".join(valid),
+                        400,
+                    )
+
+            # Paginated export, started with page=start
+            if kwargs.get("page", None):
+                # The number of records per page, or 0 for the default
+                try:
+                    size = int(kwargs.get("page_size", 0))
+                    if size < 0:
+                        raise ValueError("Negative page size %d" % size)
+                except ValueError:
+                    return Response("Invalid page_size argument", 400)
+                return self.page(
+                    req,
+                    database,
+                    uid,
+                    company,
+                    mode,
+                    statistics,
+                    sections,
+                    kwargs["page"],
+                    size,
                 )
-            except Exception as e:
-                logger.exception("Error generating frePPLe XML data")
-                raise InternalServerError(
-                    description="Error generating frePPLe XML data: check the Odoo log file for more details"
+
+            # Skip the export when the client already has the current data.
+            # The fingerprint is computed for every export, since the client
+            # needs the tag of the data it receives to ask it again later.
+            etag = self.fingerprint(
+                req, database, uid, company, mode, statistics, sections
+            )
+            # The tag is weak, because the data is sent with different
+            # compressions.
+            if etag and req.httprequest.if_none_match.contains_weak(etag):
+                return Response(
+                    status=304,
+                    headers=[("ETag", 'W/"%s"' % etag), ("Cache-Control", "no-cache")],
                 )
+
+            # Generate data.
+            # The response is streamed back to the client while it is being
+            # generated. The generator runs after this request is finished,
+            # and uses its own cursor.
+            exports = []
+            data = self.stream(
+                database,
+                uid,
+                dict(req.session.context),
+                company=company,
+                mode=mode,
+                statistics=statistics,
+                sections=sections,
+                exports=exports,
+            )
+            if etag:
+                # The client may keep the data, but must check it is still
+                # current before using it
+                headers = [
+                    ("Content-Type", "application/xml;charset=utf8"),
+                    ("Cache-Control", "no-cache"),
+                    ("ETag", 'W/"%s"' % etag),
+                    ("Vary", "Accept-Encoding"),
+                ]
+            else:
+                headers = [
+                    ("Content-Type", "application/xml;charset=utf8"),
+                    ("Cache-Control", "no-cache, no-store, must-revalidate"),
+                    ("Pragma", "no-cache"),
+                    ("Expires", "0"),
+                    ("Vary", "Accept-Encoding"),
+                ]
+
+            # The XML data is very repetitive and compresses well
+            encoding = req.httprequest.accept_encodings.best_match(["gzip", "deflate"])
+            if encoding:
+                data = compress(data, encoding)
+                headers.append(("Content-Encoding", encoding))
+
+            # The watermarks are saved once the web server has sent the last
+            # chunk, compressed or not. A client disconnecting halfway gets
+            # the same changes again in its next delta export.
+            data = acknowledged(
+                data, lambda: [xp.save_watermarks() for xp in exports]
+            )
+            return Response(data, headers=headers, direct_passthrough=True)
         elif req.httprequest.method == "POST":
             # Authenticate the user
             database = req.httprequest.form.get("database", None)
@@ -151,6 +793,26 @@ class XMLController(odoo.http.Controller):
                 logger.warning("Incorrect or missing webtoken %s " % e)
                 return Response("Incorrect or missing webtoken", 401)
 
+            # Queue the import in a background job when asked to. The status of
+            # the job is polled on /frepple/import/status.
+            if req.httprequest.form.get("async", None) in ("1", "true"):
+                try:
+                    job = self.queue_import(req, company)
+                except Exception as e:
+                    logger.exception("Error queuing data posted by frePPLe")
+                    raise InternalServerError(
+                        description="Error queuing data posted by frePPLe: check the Odoo log file for more details"
+                    )
+                return req.make_response(
+                    json.dumps({"job": job.id}),
+                    [
+                        ("Content-Type", "application/json"),
+                        ("Cache-Control", "no-cache, no-store, must-revalidate"),
+                        ("Pragma", "no-cache"),
+                        ("Expires", "0"),
+                    ],
+                )
+
             # Import the data
             try:
                 ip = importer(
@@ -18,17 +18,23 @@
 import odoo
 import logging
 from xml.etree.cElementTree import iterparse
-from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
 
 class importer(object):
-    def __init__(self, req, database=None, company=None, mode=1):
-        self.env = req.env
+    def __init__(
+        self, req, database=None, company=None, mode=1, env=None, datafile=None
+    ):
+        # A background import job passes its own environment and the file it
+        # stored, as there is no HTTP request.
+        self.env = env if env is not None else req.env
         self.database = database
         self.company = company
-        self.datafile = req.httprequest.files.get("frePPLe plan")
+        if datafile is not None:
+            self.datafile = datafile
+        else:
+            self.datafile = req.httprequest.files.get("frePPLe plan")
 
         # The mode argument defines different types of runs:
         #  - Mode 1:
@@ -39,47 +45,81 @@ class importer(object):
         #    In this mode mode we are not erasing any previous proposals.
         self.mode = mode
 
+        # Purchase orders, their lines and manufacturing orders are created in
+        # batches of this size
+        self.batch_size = 1000
+
+        # Optional function called with the number of procurement and
+        # manufacturing orders created so far and the list of errors, every
+        # batch_size orders and at the end. The procurement orders are only
+        # created at the end.
+        self.progress = None
+
     def run(self):
         msg = []
+        self.msg = msg
+        self.errors = []
 
-        proc_order = self.env["purchase.order"]
-        proc_orderline = self.env["purchase.order.line"]
-        mfg_order = self.env["mrp.production"]
         if self.mode == 1:
             # Cancel previous draft purchase quotations
-            m = self.env["purchase.order"]
-            recs = m.search([("state", "=", "draft"), ("origin", "=", "frePPLe")])
-            recs.write({"state": "cancel"})
-            recs.unlink()
-            msg.append("Removed %s old draft purchase orders" % len(recs))
+            orders, lines = self.remove_proposals(
+                "purchase.order",
+                [("state", "=", "draft"), ("origin", "=", "frePPLe")],
+                # Draft quotations have no receipts or bills yet
+                "delete from purchase_order_line where order_id in %s",
+            )
+            msg.append("Removed %s old draft purchase orders" % orders)
+            msg.append("Removed %s old draft purchase order lines" % lines)
 
             # Cancel previous draft manufacturing orders
-            recs = mfg_order.search(
+            orders, moves = self.remove_proposals(
+                "mrp.production",
                 [
                     "|",
                     ("state", "=", "draft"),
                     ("state", "=", "cancel"),
                     ("origin", "=", "frePPLe"),
-                ]
+                ],
+                # Only the moves that aren't reserved or processed in any way.
+                # The ORM cancels and removes the others with the orders.
+                "delete from stock_move "
+                "where (raw_material_production_id in %s or production_id in %s) "
+                "and state in ('draft', 'cancel') "
+                "and not exists ("
+                "select 1 from stock_move_line "
+                "where stock_move_line.move_id = stock_move.id"
+                ")",
             )
-            recs.write({"state": "cancel"})
-            recs.unlink()
-            msg.append("Removed %s old draft manufacturing orders" % len(recs))
+            msg.append("Removed %s old draft manufacturing orders" % orders)
+            msg.append("Removed %s old draft stock moves" % moves)
 
         # Parsing the XML data file
         countproc = 0
         countmfg = 0
+        countplans = 0
 
         # dictionary that stores as key the supplier id and the associated po id
         # this dict is used to aggregate the exported POs for a same supplier
         # into one PO in odoo with multiple lines
-        supplier_reference = {}
+        self.supplier_reference = {}
 
         # dictionary that stores as key a tuple (product id, supplier id)
-        # and as value a poline odoo object
+        # and as value the values of a poline
         # this dict is used to aggregate POs for the same product supplier
         # into one PO with sum of quantities and min date
-        product_supplier_dict = {}
+        # The lines are only created after parsing, with their final quantity
+        # and date.
+        self.product_supplier_dict = {}
+
+        # Number of procurement orders aggregated in each line of
+        # product_supplier_dict, with the same key
+        self.product_supplier_count = {}
+
+        # Purchase orders waiting to be created, per supplier id
+        self.po_pending = {}
+
+        # Manufacturing orders waiting to be created
+        self.mo_pending = []
 
         for event, elem in iterparse(self.datafile, events=("start", "end")):
             if event == "end" and elem.tag == "operationplan":
@@ -89,50 +129,48 @@ class importer(object):
                     if ordertype == "PO":
                         # Create purchase order
                         supplier_id = int(elem.get("supplier").split(" ", 1)[0])
-                        if supplier_id not in supplier_reference:
-                            po = proc_order.create(
-                                {
-                                    "company_id": self.company.id,
-                                    "partner_id": int(
-                                        elem.get("supplier").split(" ", 1)[0]
-                                    ),
-                                    # TODO Odoo has no place to store the location and criticality
-                                    # int(elem.get('location_id')),
-                                    # elem.get('criticality'),
-                                    "origin": "frePPLe",
-                                }
-                            )
-                            supplier_reference[supplier_id] = po.id
+                        if (
+                            supplier_id not in self.supplier_reference
+                            and supplier_id not in self.po_pending
+                        ):
+                            self.po_pending[supplier_id] = {
+                                "company_id": self.company.id,
+                                "partner_id": supplier_id,
+                                # TODO Odoo has no place to store the location and criticality
+                                # int(elem.get('location_id')),
+                                # elem.get('criticality'),
+                                "origin": "frePPLe",
+                            }
 
                         quantity = elem.get("quantity")
                         date_planned = elem.get("end")
-                        if (item_id, supplier_id) not in product_supplier_dict:
-                            po_line = proc_orderline.create(
-                                {
-                                    "order_id": supplier_reference[supplier_id],
-                                    "product_id": int(item_id),
-                                    "product_qty": quantity,
-                                    "product_uom": int(uom_id),
-                                    "date_planned": date_planned,
-                                    "price_unit": 0,
-                                    "name": elem.get("item"),
-                                }
-                            )
-                            product_supplier_dict[(item_id, supplier_id)] = po_line
+                        key = (item_id, supplier_id)
+                        if key not in self.product_supplier_dict:
+                            self.product_supplier_dict[key] = {
+                                "product_id": int(item_id),
+                                "product_qty": float(quantity),
+                                "product_uom": int(uom_id),
+                                "date_planned": date_planned,
+                                "price_unit": 0,
+                                "name": elem.get("item"),
+                            }
 
                         else:
-                            po_line = product_supplier_dict[(item_id, supplier_id)]
-                            po_line.date_planned = min(
-                                po_line.date_planned,
-                                datetime.strptime(date_planned, "%Y-%m-%d %H:%M:%S"),
+                            po_line = self.product_supplier_dict[key]
+                            # The dates all have the same format, and compare
+                            # correctly as strings
+                            po_line["date_planned"] = min(
+                                po_line["date_planned"], date_planned
                             )
-                            po_line.product_qty = po_line.product_qty + float(quantity)
-                        countproc += 1
+                            po_line["product_qty"] += float(quantity)
+                        self.product_supplier_count[key] = (
+                            self.product_supplier_count.get(key, 0) + 1
+                        )
                     # TODO Create a distribution order
                     # elif ????:
                     else:
                         # Create manufacturing order
-                        mfg_order.create(
+                        self.mo_pending.append(
                             {
                                 "product_qty": elem.get("quantity"),
                                 "date_planned_start": elem.get("start"),
@@ -147,17 +185,162 @@ class importer(object):
                                 "origin": "frePPLe",
                             }
                         )
-                        countmfg += 1
+                        if len(self.mo_pending) >= self.batch_size:
+                            countmfg += self.flush_manufacturing_orders()
                 except Exception as e:
                     logger.error("Exception %s" % e)
                     msg.append(str(e))
+                    self.errors.append(str(e))
                 # Remove the element now to keep the DOM tree small
                 root.clear()
+                countplans += 1
+                if self.progress and countplans % self.batch_size == 0:
+                    self.progress(countproc, countmfg, self.errors)
             elif event == "start" and elem.tag == "operationplans":
                 # Remember the root element
                 root = elem
 
+        countproc += self.flush_purchase_orders()
+        countmfg += self.flush_manufacturing_orders()
+        if self.progress:
+            self.progress(countproc, countmfg, self.errors)
+
         # Be polite, and reply to the post
         msg.append("Processed %s uploaded procurement orders" % countproc)
         msg.append("Processed %s uploaded manufacturing orders" % countmfg)
         return "\n".join(msg)
+
+    def remove_proposals(self, model, domain, query):
+        """
+        Remove the proposals of the previous plan, and return the number of
+        records and child records removed.
+
+        The records are removed in batches, each in its own transaction, which
+        keeps the memory usage flat and doesn't lock all records for the whole
+        cleanup. The query removes their child records with SQL first, rather
+        than loading them in the ORM. It gets the ids of the batch as argument
+        for every placeholder.
+        """
+        # frePPLe never received these proposals: their deletion isn't logged
+        m = self.env[model].with_context(
+            tracking_disable=True, frepple_skip_deletions=True
+        )
+        count = 0
+        children = 0
+        while True:
+            recs = m.search(domain, order="id", limit=self.batch_size)
+            if not recs:
+                break
+            ids = tuple(recs.ids)
+            self.env.cr.execute(query, (ids,) * query.count("%s"))
+            children += self.env.cr.rowcount
+            self.env.invalidate_all()
+            recs.write({"state": "cancel"})
+            recs.unlink()
+            count += len(ids)
+            self.env.cr.commit()
+        return count, children
+
+    def flush_purchase_orders(self):
+        """
+        Create the purchase orders and purchase order lines collected while
+        parsing the plan, and return how many procurement orders of the plan
+        the created lines hold.
+
+        The records are created in batches, with a single create call per
+        batch, which lets the ORM process the computed fields of all records of
+        the batch at once. Every line is created with its final quantity and
+        date, and never updated afterwards.
+        """
+        suppliers = list(self.po_pending.keys())
+        m = self.env["purchase.order"]
+        for start in range(0, len(suppliers), self.batch_size):
+            batch = suppliers[start : start + self.batch_size]
+            orders = self.create_batch(m, [self.po_pending[i] for i in batch])
+            for supplier_id, po in zip(batch, orders):
+                if po:
+                    self.supplier_reference[supplier_id] = po.id
+        self.po_pending = {}
+
+        lines = []
+        counts = []
+        for key, vals in self.product_supplier_dict.items():
+            # Skip the lines of purchase orders that couldn't be created
+            if key[1] in self.supplier_reference:
+                vals["order_id"] = self.supplier_reference[key[1]]
+                lines.append(vals)
+                counts.append(self.product_supplier_count[key])
+        m = self.env["purchase.order.line"]
+        count = 0
+        for start in range(0, len(lines), self.batch_size):
+            created = self.create_batch(m, lines[start : start + self.batch_size])
+            count += sum(
+                j for i, j in zip(created, counts[start : start + self.batch_size]) if i
+            )
+        self.product_supplier_dict = {}
+        self.product_supplier_count = {}
+        return count
+
+    def flush_manufacturing_orders(self):
+        """
+        Create the pending manufacturing orders, and return how many were
+        created.
+
+        The orders are created without mail tracking, logging and followers in
+        the chatter. The stock moves aren't generated per batch: the create of
+        Odoo 13 generates them order by order, and _generate_moves has no batch
+        implementation to call instead. Batching the orders only saves the
+        overhead around it. Work orders are only created when an order is
+        planned, not here.
+
+        An order is created together with its moves in the same savepoint, so
+        an order whose moves fail is rolled back and reported, and never left
+        behind without its moves.
+        """
+        m = self.env["mrp.production"].with_context(
+            tracking_disable=True,
+            mail_create_nolog=True,
+            mail_create_nosubscribe=True,
+            mail_notrack=True,
+        )
+        orders = self.create_batch(m, self.mo_pending)
+        self.mo_pending = []
+        return len([i for i in orders if i])
+
+    def create_batch(self, m, vals_list):
+        """
+        Create a list of records of a model, and return a list with the record
+        or None for every element of the list.
+
+        When creating them all at once fails, the records are created one by one
+        instead. The records that fail are then reported, without affecting
+        the others.
+
+        The records are flushed to the database within the savepoint, so that
+        errors raised by the database are caught as well. After a failure the
+        cache is cleared: it still holds the records the savepoint rolled back.
+        """
+        if not vals_list:
+            return []
+        try:
+            with self.env.cr.savepoint():
+                records = m.create(vals_list)
+                m.flush()
+                return list(records)
+        except Exception as e:
+            logger.warning("Batch creation of %s failed: %s" % (m._name, e))
+            self.env.clear()
+        result = []
+        for vals in vals_list:
+            try:
+                with self.env.cr.savepoint():
+                    record = m.create(vals)
+                    m.flush()
+                    result.append(record)
+            except Exception as e:
+                self.env.clear()
+                logger.error("Exception %s" % e)
+                self.msg.append(str(e))
+                self.errors.append(str(e))
+                result.append(None)
+        return result
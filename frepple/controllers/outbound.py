@@ -15,21 +15,143 @@
 # You should have received a copy of the GNU Affero General Public
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import hashlib
+import json
 import logging
+import time
 from xml.sax.saxutils import quoteattr
 from datetime import datetime, timedelta
+from itertools import islice
 from operator import itemgetter
 
 import odoo
 
 logger = logging.getLogger(__name__)
 
+try:
+    import numpy
+except ImportError:
+    # Batches of quantities are then converted in plain Python
+    numpy = None
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: the memory usage isn't reported then
+    resource = None
+
 
 class exporter(object):
-    def __init__(self, req, uid, database=None, company=None, mode=1):
+    # The delta mode exports the records changed since the watermark of their
+    # section.
+    delta_sections = (
+        "customers",
+        "suppliers",
+        "items",
+        "boms",
+        "salesorders",
+        "purchaseorders",
+        "manufacturingorders",
+        "orderpoints",
+    )
+
+    # The models each section reads, which the fingerprint of an export is
+    # computed from. A section also reads the models of the maps it looks up,
+    # such as the products, the customers, the locations or the operations of
+    # the boms, even when the sections building these maps aren't exported.
+    section_models = {
+        "calendar": (
+            "resource.calendar",
+            "resource.calendar.attendance",
+            "hr.holidays.public.line",
+        ),
+        "locations": ("stock.location", "stock.warehouse"),
+        "customers": ("res.partner",),
+        "suppliers": ("res.partner",),
+        "skills": ("mrp.skill",),
+        "workcenterskills": ("mrp.workcenter.skill", "mrp.skill", "mrp.workcenter"),
+        "workcenters": ("mrp.workcenter",),
+        "items": (
+            "product.category",
+            "product.template",
+            "product.product",
+            "product.supplierinfo",
+            "res.partner",
+        ),
+        "boms": (
+            "mrp.bom",
+            "mrp.bom.line",
+            "mrp.routing",
+            "mrp.routing.workcenter",
+            "mrp.subproduct",
+            "mrp.workcenter",
+            "mrp.skill",
+            "product.template",
+            "product.product",
+        ),
+        "salesorders": (
+            "sale.order",
+            "sale.order.line",
+            "product.template",
+            "product.product",
+            "res.partner",
+            "stock.warehouse",
+        ),
+        "purchaseorders": (
+            "purchase.order",
+            "purchase.order.line",
+            "product.template",
+            "product.product",
+            "res.partner",
+        ),
+        "manufacturingorders": (
+            "mrp.production",
+            "mrp.bom",
+            "mrp.routing.workcenter",
+            "stock.location",
+            "stock.warehouse",
+            "product.template",
+            "product.product",
+        ),
+        "orderpoints": (
+            "stock.warehouse.orderpoint",
+            "stock.warehouse",
+            "product.template",
+            "product.product",
+        ),
+        "onhand": (
+            "stock.quant",
+            "stock.location",
+            "stock.warehouse",
+            "product.template",
+            "product.product",
+        ),
+    }
+
+    def __init__(
+        self,
+        req,
+        uid,
+        database=None,
+        company=None,
+        mode=1,
+        env=None,
+        statistics=False,
+        acknowledge=True,
+        page=None,
+        sections=None,
+    ):
         self.database = database
         self.company = company
 
+        # Statistics are collected for every section and logged. When the
+        # statistics argument is set, they are also added as a comment at the
+        # end of the XML document.
+        self.statistics = statistics
+        self.stats = []
+        self.rows_read = 0
+        self.queries = 0
+
         # The mode argument defines different types of runs:
         #  - Mode 1:
         #    This mode returns all data that is loaded with every planning run.
@@ -38,6 +160,11 @@ class exporter(object):
         #    This mode returns data that is loaded that changes infrequently and
         #    can be transferred during automated scheduled runs at a quiet moment.
         #    Currently this mode transfers only closed sales orders.
+        #  - Mode 3:
+        #    This mode returns the same data as mode 1, but only the records that were
+        #    created or updated since the last complete export of the company. Records
+        #    deleted since then are sent with a removal action.
+        #    It allows frequent replanning without transferring all data every time.
         #
         # Normally an Odoo object should be exported by only a single mode.
         # Exporting a certain object with BOTH modes 1 and 2 will only create extra
@@ -47,20 +174,77 @@ class exporter(object):
         # Which data elements belong to each mode can vary between implementations.
         self.mode = mode
 
-        # Initialize an environment
-        self.env = req.env
+        # The watermarks are moved back a bit to also catch changes of
+        # transactions that were still in progress during the previous export.
+        self.watermark_overlap = timedelta(minutes=10)
+
+        # A complete export moves the watermarks of the company forward, unless
+        # it isn't sent to frePPLe right away.
+        self.acknowledge = acknowledge
+
+        # An export can be limited to some sections. The sections then load only
+        # the data they need from the sections they depend on, rather than
+        # running them completely.
+        self.sections = sections
+
+        # Maps used by multiple sections. They are built by the section they
+        # belong to, or by the load methods when that section isn't exported.
+        #  - map_locations: stock locations to warehouses, see load_locations
+        #  - product_product: products to their name and template, see
+        #    load_products
+        #  - map_customers: customers to their name, see load_customers
+        #  - operations: operations of the bills of material, see load_boms
+        self.map_locations = None
+        self.product_product = None
+        self.map_customers = None
+        self.operations = None
+        self.template_uom = None
+
+        # Generation of the cache of reference data, see cached
+        self.cache_generation = None
+
+        # Number of records read at once by the sections processing big tables
+        self.batch_size = 5000
+
+        # A paginated export returns a single page per run. The page argument is
+        # the position where the page starts, as returned in next_page by the
+        # run of the previous page. An empty dict is the start of the export.
+        # A page holds either a whole section, or up to page_size records of a
+        # section reading a big table.
+        self.page = page
+        self.page_size = 10000
+        self.page_last = None
+        self.next_page = None
+
+        # Initialize an environment.
+        # When the output is streamed back to the client, the generator outlives
+        # the HTTP request and its cursor. The caller then passes a dedicated
+        # environment instead.
+        self.env = env if env is not None else req.env
 
     def run(self):
         # Check if we manage by work orders or manufacturing orders.
-        self.manage_work_orders = False
-        m = self.env["ir.model"]
-        recs = m.search([("model", "=", "mrp.workorder")])
-        for rec in recs:
-            self.manage_work_orders = True
+        self.manage_work_orders = self.cached(
+            ("manage_work_orders",),
+            lambda: bool(
+                self.env["ir.model"].search([("model", "=", "mrp.workorder")])
+            ),
+        )
+
+        # Sales order lines can be read with SQL instead of the ORM, which is a lot
+        # faster on big databases.
+        self.sql_salesorders = (
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("frepple.sql_salesorders", "False")
+            .lower()
+            in ("1", "true")
+        )
 
         # Load some auxiliary data in memory
         self.load_company()
         self.load_uom()
+        self.load_watermarks()
 
         # Header.
         # The source attribute is set to 'odoo_<mode>', such that all objects created or
@@ -69,48 +253,298 @@ class exporter(object):
         yield '<plan xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" source="odoo_%s">\n' % self.mode
 
         # Main content.
-        # The order of the entities is important. First one needs to create the
-        # objects before they are referenced by other objects.
-        # If multiple types of an entity exists (eg operation_time_per,
-        # operation_alternate, operation_alternate, etc) the reference would
-        # automatically create an object, potentially of the wrong type.
-        if self.mode == 1:
-            for i in self.export_calendar():
-                yield i
-        for i in self.export_locations():
-            yield i
-        for i in self.export_customers():
-            yield i
-        if self.mode == 1:
-            for i in self.export_suppliers():
-                yield i
-            for i in self.export_skills():
-                yield i
-            for i in self.export_workcenters():
-                yield i
-            for i in self.export_workcenterskills():
-                yield i
-        for i in self.export_items():
-            yield i
-        if self.mode == 1:
-            for i in self.export_boms():
-                yield i
-        for i in self.export_salesorders():
-            yield i
-        if self.mode == 1:
-            for i in self.export_purchaseorders():
-                yield i
-            for i in self.export_manufacturingorders():
-                yield i
-            for i in self.export_orderpoints():
-                yield i
-            for i in self.export_onhand():
+        sections = self.get_sections()
+        if self.page is not None:
+            sections = self.get_page_sections(sections)
+        for section in sections:
+            for i in self.instrument(section, getattr(self, "export_%s" % section)()):
                 yield i
+        if self.page is not None:
+            self.next_page = self.get_next_page(sections)
+
+        # Statistics of the sections
+        if self.statistics:
+            yield "<!-- export statistics\n"
+            for i in self.stats:
+                yield "%s\n" % json.dumps(i)
+            yield "-->\n"
 
         # Footer
         yield "</plan>\n"
 
+    def get_sections(self):
+        """
+        Return the list of sections to export in this mode.
+
+        The order of the entities is important. First one needs to create the
+        objects before they are referenced by other objects.
+        If multiple types of an entity exists (eg operation_time_per,
+        operation_alternate, operation_alternate, etc) the reference would
+        automatically create an object, potentially of the wrong type.
+
+        An export limited to some sections returns only those, in the same
+        order.
+        """
+        if self.mode in (1, 3):
+            sections = [
+                "calendar",
+                "locations",
+                "customers",
+                "suppliers",
+                "skills",
+                "workcenters",
+                "workcenterskills",
+                "items",
+                "boms",
+                "salesorders",
+                "purchaseorders",
+                "manufacturingorders",
+                "orderpoints",
+                "onhand",
+            ]
+        else:
+            sections = ["locations", "customers", "items", "salesorders"]
+        if self.sections:
+            sections = [i for i in sections if i in self.sections]
+        return sections
+
+    def fingerprint(self):
+        """
+        Return a fingerprint of the data of this export, without running it.
+
+        It is computed from the number of records and the last update time of
+        every model the sections read. Creating, updating or deleting a record
+        changes it. This is a lot cheaper than the export, but still scans all
+        these tables, including the sales order lines and the stock quants. The
+        cost is paid on every export of modes 1 and 2, also when the client
+        sends no If-None-Match header: the tag has to be sent along with the
+        data. Configure a read replica to keep that load off the primary
+        database.
+
+        The export of the delta mode depends on the watermarks as well, and an
+        export with statistics is never the same. Neither has a fingerprint,
+        and None is returned instead.
+        """
+        if self.mode not in (1, 2) or self.statistics:
+            return None
+        # The settings, the company with its calendar and manufacturing
+        # warehouse, and the units of measure are read by every export.
+        models = {
+            "ir.module.module",
+            "ir.config_parameter",
+            "res.company",
+            "resource.calendar",
+            "stock.warehouse",
+            "uom.uom",
+        }
+        for section in self.get_sections():
+            models.update(self.section_models.get(section, ()))
+        key = (
+            self.mode,
+            self.company,
+            self.env.uid,
+            self.env.context.get("lang", None),
+            self.get_sections(),
+            self.table_fingerprint(models),
+        )
+        return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+    def table_fingerprint(self, models):
+        """
+        Return the number of records and the last update time of the tables of
+        some models, read in a single query. Creating, updating or deleting a
+        record changes it. Models that aren't installed are skipped.
+        """
+        tables = sorted(self.env[i]._table for i in models if i in self.env)
+        self.env.cr.execute(
+            " union all ".join(
+                "select %d, count(*), max(write_date) from %s" % i
+                for i in enumerate(tables)
+            )
+        )
+        rows = sorted(self.env.cr.fetchall())
+        self.queries += 1
+        return tuple((tables[i[0]], i[1], str(i[2])) for i in rows)
+
+    def get_page_sections(self, sections):
+        """
+        Return the section of the page to export.
+
+        After the last page, the client asks one more page without any section.
+        It acknowledges that all pages have been received.
+        """
+        section = self.page.get("section", sections[0] if sections else None)
+        return [section] if section else []
+
+    def check_page(self):
+        """
+        Verify the position where a page of a paginated export starts, as the
+        client passed it back. Raises a ValueError when it isn't a position
+        this export can return.
+        """
+        section = self.page.get("section", None)
+        if section is not None and section not in self.get_sections():
+            raise ValueError("Invalid section %r" % (section,))
+        key = self.page.get("key", 0)
+        if not isinstance(key, int) or isinstance(key, bool) or key < 0:
+            raise ValueError("Invalid key %r" % (key,))
+        date = self.page.get("date", None)
+        if date is not None:
+            if not isinstance(date, str):
+                raise ValueError("Invalid date %r" % (date,))
+            datetime.strptime(date, "%Y-%m-%d %H:%M:%S.%f")
+
+    def get_next_page(self, sections):
+        """
+        Return the position where the next page starts.
+
+        The pages follow the order of the sections. The position of a page
+        within a section is the id of the last record on the previous page, and
+        the export date is passed on so all pages get the same watermarks.
+        Returns None after the acknowledgement page.
+        """
+        if not sections:
+            return None
+        page = {
+            "date": self.export_date.strftime("%Y-%m-%d %H:%M:%S.%f"),
+            "section": sections[0],
+            "key": self.page_last,
+        }
+        if not self.page_last:
+            all_sections = self.get_sections()
+            index = all_sections.index(sections[0]) + 1
+            page["section"] = (
+                all_sections[index] if index < len(all_sections) else None
+            )
+            page["key"] = 0
+        return page
+
+    def search_page(self, section, model, domain):
+        """
+        Search the records of a section.
+
+        In a paginated export, only the records on the page are returned. This
+        uses keyset pagination: the search starts right after the id of the last
+        record of the previous page, which the database finds with the primary
+        key index. Skipping the records of the previous pages with an offset
+        would get slower on every page.
+        """
+        m = self.env[model]
+        if self.page is None:
+            return m.search(domain)
+        recs = m.search(
+            domain + [("id", ">", self.page.get("key", 0))],
+            order="id",
+            limit=self.page_size,
+        )
+        if len(recs) == self.page_size:
+            self.page_last = recs.ids[-1]
+        return recs
+
+    def instrument(self, section, generator):
+        """
+        Wrap the generator of a section to collect statistics on it:
+          - time spent in the generator, excluding the time the consumer needs
+            to process the output
+          - number of rows read from the database
+          - size of the output generated
+          - number of SQL queries executed
+          - increase of the peak memory usage of the process, where the
+            resource module is available
+        The statistics are logged at the end of the section.
+
+        The size is counted in characters, which is cheap. Counting it in bytes
+        means encoding every fragment a second time, which is only done when the
+        statistics are requested. Both are the same for ascii data.
+        """
+        if self.statistics:
+            measure = lambda i: len(i.encode("utf-8"))
+        else:
+            measure = len
+        rows = self.rows_read
+        queries = self.queries + getattr(self.env.cr, "sql_log_count", 0)
+        if resource:
+            memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        elapsed = 0.0
+        size = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                i = next(generator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            size += measure(i)
+            yield i
+        stats = {
+            "section": section,
+            "time": round(elapsed, 3),
+            "rows": self.rows_read - rows,
+            "bytes": size,
+            "queries": self.queries
+            + getattr(self.env.cr, "sql_log_count", 0)
+            - queries,
+        }
+        if resource:
+            # Reported in kB on Linux
+            stats["memory"] = (
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory
+            )
+        self.stats.append(stats)
+        logger.info("frePPLe export statistics %s" % json.dumps(stats))
+
+    def read_records(self, recs, fields):
+        """
+        Read records without calling name_get on many2one fields, and count
+        the rows read.
+        """
+        rows = recs.read(fields, load=None)
+        self.rows_read += len(rows)
+        return rows
+
+    def cached(self, key, loader, fingerprint=()):
+        """
+        Get reference data from the cache shared by all exports of the database,
+        calling the loader to build it when it isn't cached yet.
+
+        The data is built again when the records it is built from change: the
+        generation of the cache is increased by the models rarely changing, see
+        the frepple.cache model, and the optional fingerprint identifies the
+        version of the other records. A single version is cached per key. The
+        returned data must not be modified.
+
+        The data is read with the access rights and record rules of the user,
+        which can also depend on the companies the user has selected. The key
+        therefore includes the user and the allowed companies.
+        """
+        if self.cache_generation is None:
+            self.cache_generation = self.env["frepple.cache"].get_generation()
+        key = (self.env.uid, tuple(self.env.companies.ids)) + tuple(key)
+        return self.env["frepple.cache"].get(
+            key, (self.cache_generation,) + tuple(fingerprint), loader
+        )
+
     def load_company(self):
+        company = self.cached(("company", self.company), self.read_company)
+        self.company_id = 0
+        if company:
+            self.company_id = company["id"]
+            self.security_lead = company["security_lead"]
+            self.po_lead = company["po_lead"]
+            self.manufacturing_lead = company["manufacturing_lead"]
+            self.calendar = company["calendar"]
+            self.mfg_location = company["mfg_location"]
+        if not self.company_id:
+            logger.warning("Can't find company '%s'" % self.company)
+            self.company_id = None
+            self.security_lead = 0
+            self.po_lead = 0
+            self.manufacturing_lead = 0
+            self.calendar = "Working hours"
+            self.mfg_location = self.company
+
+    def read_company(self):
         m = self.env["res.company"]
         recs = m.search([("name", "=", self.company)])
         fields = [
@@ -120,28 +554,213 @@ class exporter(object):
             "calendar",
             "manufacturing_warehouse",
         ]
-        self.company_id = 0
-        for i in recs.read(fields):
-            self.company_id = i["id"]
-            self.security_lead = int(
-                i["security_lead"]
-            )  # TODO NOT USED RIGHT NOW - add parameter in frepple for this
-            self.po_lead = i["po_lead"]
-            self.manufacturing_lead = i["manufacturing_lead"]
-            self.calendar = i["calendar"] and i["calendar"][1] or "Working hours"
-            self.mfg_location = (
-                i["manufacturing_warehouse"]
-                and i["manufacturing_warehouse"][1]
-                or self.company
+        company = None
+        for i in self.read_records(recs, fields):
+            company = {
+                "id": i["id"],
+                # TODO NOT USED RIGHT NOW - add parameter in frepple for this
+                "security_lead": int(i["security_lead"]),
+                "po_lead": i["po_lead"],
+                "manufacturing_lead": i["manufacturing_lead"],
+                "calendar": i["calendar"]
+                and self.load_names("resource.calendar", [i["calendar"]])[
+                    i["calendar"]
+                ]
+                or "Working hours",
+                "mfg_location": i["manufacturing_warehouse"]
+                and self.load_names(
+                    "stock.warehouse", [i["manufacturing_warehouse"]]
+                )[i["manufacturing_warehouse"]]
+                or self.company,
+            }
+        return company
+
+    def split_batches(self, iterable):
+        """
+        Group the elements of an iterable in lists of the batch size.
+        """
+        iterator = iter(iterable)
+        while True:
+            batch = list(islice(iterator, self.batch_size))
+            if not batch:
+                return
+            yield batch
+
+    def read_batches(self, recs, fields):
+        """
+        Read records in batches of a fixed size, and yield a list of rows per
+        batch.
+
+        The ORM cache is cleared after the caller has processed each batch. The
+        records read for the batch, and any related records the caller read
+        along with them, don't pile up in memory.
+        The search only retrieves the ids, so the memory usage stays flat no
+        matter how big the table is.
+        """
+        ids = recs.ids
+        for start in range(0, len(ids), self.batch_size):
+            batch = recs.browse(ids[start : start + self.batch_size])
+            yield self.read_records(batch, fields)
+            batch.invalidate_cache()
+
+    def load_names(self, model, ids, field="name"):
+        """
+        Read the names of a set of records in a single query.
+
+        The exporter reads many2one fields as raw ids, which avoids calling
+        name_get on every record. The names it needs are read with this method
+        instead. The field must be the stored field that name_get returns.
+
+        Like the names read along with many2one fields, they are read as
+        superuser. A record referenced from a record of the user, but which
+        belongs to another company, doesn't make the export fail.
+        """
+        ids = list(set(i for i in ids if i))
+        if not ids:
+            return {}
+        return {
+            i["id"]: i[field]
+            for i in self.read_records(self.env[model].sudo().browse(ids), [field])
+        }
+
+    def stream_query(self, query, params=None, itersize=10000):
+        """
+        Iterate over the result of a SQL query with a server-side cursor.
+
+        Only a batch of rows is kept in memory at any time, which keeps the
+        memory usage flat on very large tables. The query runs in the same
+        transaction as the rest of the export.
+        """
+        cr = self.env.cr._cnx.cursor("frepple_%s" % id(self))
+        try:
+            cr.itersize = itersize
+            cr.execute(query, params)
+            self.queries += 1
+            for i in cr:
+                self.rows_read += 1
+                yield i
+        finally:
+            cr.close()
+
+    def load_watermarks(self):
+        """
+        Load the watermarks of the previous exports of the company.
+
+        The transaction time of this export becomes the new watermark once the
+        export has been completely sent. On a read replica, the data is only as
+        recent as the last transaction replayed from the primary.
+        """
+        self.env.cr.execute(
+            """
+            select (
+              case when pg_is_in_recovery()
+              then coalesce(pg_last_xact_replay_timestamp(), now())
+              else now() end
+              ) at time zone 'utc'
+            """
+        )
+        self.export_date = self.env.cr.fetchone()[0]
+        if self.page and self.page.get("date", None):
+            # All pages of an export use the date of its first page
+            self.export_date = datetime.strptime(
+                self.page["date"], "%Y-%m-%d %H:%M:%S.%f"
             )
-        if not self.company_id:
-            logger.warning("Can't find company '%s'" % self.company)
-            self.company_id = None
-            self.security_lead = 0
-            self.po_lead = 0
-            self.manufacturing_lead = 0
-            self.calendar = "Working hours"
-            self.mfg_location = self.company
+        self.watermarks = {}
+        if self.mode != 3 or not self.company_id:
+            return
+        m = self.env["frepple.watermark"]
+        recs = m.search([("company_id", "=", self.company_id)])
+        for i in self.read_records(recs, ["section", "date"]):
+            self.watermarks[i["section"]] = i["date"] - self.watermark_overlap
+
+    def save_watermarks(self):
+        """
+        Store the watermarks of the sections exported by this run.
+
+        This uses a separate transaction, as the export itself is read-only.
+        The caller saves them once the client has received the whole export,
+        not when the run ends: the last chunks can still be buffered then.
+        A paginated export saves them when the client acknowledges it has
+        received all pages. An export limited to some sections only moves the
+        watermarks of those sections.
+        """
+        if not self.acknowledge or self.mode not in (1, 3) or not self.company_id:
+            return
+        if self.page is not None and self.next_page is not None:
+            return
+        with odoo.registry(self.env.cr.dbname).cursor() as cr:
+            env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})
+            env["frepple.watermark"].update_watermarks(
+                self.company_id,
+                [i for i in self.delta_sections if i in self.get_sections()],
+                self.export_date,
+            )
+
+    def delta_domain(self, section, domain, paths=()):
+        """
+        In delta mode, restrict a search domain to the records created or updated
+        since the watermark of the section.
+        The optional paths are many2one fields whose target records are checked
+        for changes as well.
+        """
+        since = self.watermarks.get(section, None)
+        if not since:
+            return domain
+        terms = []
+        for p in ("",) + tuple("%s." % i for i in paths):
+            terms.append(("%swrite_date" % p, ">", since))
+            terms.append(("%screate_date" % p, ">", since))
+        return domain + ["|"] * (len(terms) - 1) + terms
+
+    def is_changed(self, section, rec):
+        """
+        Verify whether a record was created or updated since the watermark of
+        the section. The record needs to be read with its write_date and
+        create_date.
+        """
+        since = self.watermarks.get(section, None)
+        return (
+            not since
+            or (rec["write_date"] and rec["write_date"] > since)
+            or (rec["create_date"] and rec["create_date"] > since)
+        )
+
+    def export_deletions(self, section, element, key="name", suffix=""):
+        """
+        In delta mode, generate removal markers for the records deleted since
+        the watermark of the section.
+        """
+        since = self.watermarks.get(section, None)
+        if not since or (self.page and self.page.get("key", 0)):
+            # Paginated exports send the deletions on the first page of a section
+            return
+        m = self.env["frepple.deletion"]
+        recs = m.search(
+            [
+                ("section", "=", section),
+                ("create_date", ">", since),
+                ("company_id", "in", [False, self.company_id]),
+            ]
+        )
+        for i in self.read_records(recs, ["name"]):
+            yield '<%s %s=%s action="R"/>\n' % (
+                element,
+                key,
+                quoteattr(i["name"] + suffix),
+            )
+
+    def export_archived(self, section, model, domain, fields=("name",)):
+        """
+        In delta mode, read the records of a section that were archived since
+        its watermark. Paginated exports read them on the first page of the
+        section.
+        """
+        if self.page and self.page.get("key", 0):
+            return []
+        recs = model.with_context(active_test=False).search(
+            self.delta_domain(section, domain + [("active", "=", False)])
+        )
+        return self.read_records(recs, list(fields))
 
     def load_uom(self):
         """
@@ -150,17 +769,27 @@ class exporter(object):
         All quantities are sent to frePPLe as numbers, expressed in the default
         unit of measure of the uom dimension.
         """
+        (
+            self.uom,
+            self.uom_categories,
+            self.uom_conversion,
+            self.uom_matrix,
+        ) = self.cached(("uom",), self.read_uom)
+        # Conversions between uom categories that were already reported
+        self.uom_warnings = set()
+
+    def read_uom(self):
         m = self.env["uom.uom"]
         # We also need to load INactive UOMs, because there still might be records
         # using the inactive UOM. Questionable practice, but can happen...
         recs = m.search(["|", ("active", "=", 1), ("active", "=", 0)])
         fields = ["factor", "uom_type", "category_id", "name"]
-        self.uom = {}
-        self.uom_categories = {}
-        for i in recs.read(fields):
+        uom = {}
+        uom_categories = {}
+        for i in self.read_records(recs, fields):
             if i["uom_type"] == "reference":
                 f = 1.0
-                self.uom_categories[i["category_id"][0]] = i["id"]
+                uom_categories[i["category_id"]] = i["id"]
             elif i["uom_type"] == "bigger":
                 f = 1 / i["factor"]
             else:
@@ -168,38 +797,151 @@ class exporter(object):
                     f = i["factor"]
                 else:
                     f = 1.0
-            self.uom[i["id"]] = {
+            uom[i["id"]] = {
                 "factor": f,
-                "category": i["category_id"][0],
+                "category": i["category_id"],
                 "name": i["name"],
             }
 
-    def convert_qty_uom(self, qty, uom_id, product_template_id=None):
+        # Conversion table from every uom to every possible reference uom of a
+        # product, as a multiplier, a divisor and a flag whether both are in
+        # the same category.
+        conversion = {}
+        for u_id, u in uom.items():
+            for p_id, p in uom.items():
+                if u_id == p_id:
+                    conversion[(u_id, p_id)] = (1.0, 1.0, True)
+                elif u["category"] == p["category"]:
+                    conversion[(u_id, p_id)] = (u["factor"], p["factor"], True)
+                else:
+                    conversion[(u_id, p_id)] = (u["factor"], 1.0, False)
+        if numpy is None:
+            return uom, uom_categories, conversion, None
+
+        # The same table as arrays, to convert batches of quantities at once.
+        # They are indexed by the position of the uom and of the reference uom
+        # in the sorted array of the uom ids, plus one, see uom_positions. Row 0
+        # doesn't convert, and is used for quantities without a uom. The last
+        # column is used for products without a template, and converts with
+        # the factor of the uom only.
+        ids = numpy.array(sorted(uom), dtype=int)
+        position = {u_id: p for p, u_id in enumerate(ids.tolist(), 1)}
+        size = len(ids) + 1
+        multipliers = numpy.ones((size, size + 1))
+        divisors = numpy.ones((size, size + 1))
+        same_category = numpy.ones((size, size + 1), dtype=bool)
+        for (u_id, p_id), (multiplier, divisor, same) in conversion.items():
+            multipliers[position[u_id], position[p_id]] = multiplier
+            divisors[position[u_id], position[p_id]] = divisor
+            same_category[position[u_id], position[p_id]] = same
+        for u_id, u in uom.items():
+            multipliers[position[u_id], size] = u["factor"]
+        return (
+            uom,
+            uom_categories,
+            conversion,
+            (ids, multipliers, divisors, same_category),
+        )
+
+    def uom_factor(self, uom_id, product_template_id=None):
         """
-        Convert a quantity to the reference uom of the product template.
+        Look up the multiplier and divisor that convert a quantity in a uom to
+        the reference uom of the product template.
         """
-
-        if not uom_id:
-            return qty
-        if not product_template_id:
-            return qty * self.uom[uom_id]["factor"]
         try:
-            product_uom = self.product_templates[product_template_id]["uom_id"][0]
+            product_uom = self.product_templates[product_template_id]["uom_id"]
+            multiplier, divisor, same_category = self.uom_conversion[
+                (uom_id, product_uom)
+            ]
         except Exception:
-            return qty * self.uom[uom_id]["factor"]
-        # check if default product uom is the one we received
-        if product_uom == uom_id:
-            return qty
-        # check if different uoms belong to the same category
-        if self.uom[product_uom]["category"] == self.uom[uom_id]["category"]:
-            return qty * self.uom[uom_id]["factor"] / self.uom[product_uom]["factor"]
-        else:
+            return self.uom[uom_id]["factor"], 1.0
+        if (
+            not same_category
+            and (uom_id, product_template_id) not in self.uom_warnings
+        ):
             # UOM is from a different category as the reference uom of the product.
+            self.uom_warnings.add((uom_id, product_template_id))
             logger.warning(
                 "Can't convert from %s for product template %s"
                 % (self.uom[uom_id]["name"], product_template_id)
             )
-            return qty * self.uom[uom_id]["factor"]
+        return multiplier, divisor
+
+    def convert_qty_uom(self, qty, uom_id, product_template_id=None):
+        """
+        Convert a quantity to the reference uom of the product template.
+        """
+        if not uom_id:
+            return qty
+        multiplier, divisor = self.uom_factor(uom_id, product_template_id)
+        return qty * multiplier / divisor
+
+    def convert_qty_uom_batch(self, quantities, uom_ids, product_template_ids):
+        """
+        Convert a list of quantities to the reference uom of their product
+        template. The result is the same as calling convert_qty_uom on each
+        quantity.
+
+        When numpy is available, the factors are looked up in the conversion
+        table with index arrays, and the whole batch is converted without a
+        loop in Python. The conversions between uom categories are reported
+        once per uom and product template.
+        """
+        if numpy is None or not quantities:
+            return [
+                self.convert_qty_uom(q, u, t)
+                for q, u, t in zip(quantities, uom_ids, product_template_ids)
+            ]
+        ids, multipliers, divisors, same_category = self.uom_matrix
+        # Uoms that don't exist don't convert, like quantities without a uom
+        uom_ids = numpy.array([i or 0 for i in uom_ids], dtype=int)
+        uoms = self.uom_positions(uom_ids, 0)
+        # Reference uom of the template, or the last column of the table for
+        # products without a template
+        templates = numpy.array([i or 0 for i in product_template_ids], dtype=int)
+        template_uom = self.get_template_uom()
+        templates[(templates < 0) | (templates >= len(template_uom))] = 0
+        references = template_uom[templates]
+
+        different = ~same_category[uoms, references]
+        if different.any():
+            for uom_id, product_template_id in set(
+                zip(uom_ids[different].tolist(), templates[different].tolist())
+            ):
+                self.uom_factor(uom_id, product_template_id)
+        return (
+            numpy.array(quantities, dtype=float)
+            * multipliers[uoms, references]
+            / divisors[uoms, references]
+        ).tolist()
+
+    def uom_positions(self, uom_ids, missing):
+        """
+        Return the index in the conversion table of an array of uom ids. Uoms
+        that don't exist get the missing index.
+        """
+        ids = self.uom_matrix[0]
+        if not len(ids):
+            return numpy.full(len(uom_ids), missing, dtype=int)
+        positions = numpy.minimum(numpy.searchsorted(ids, uom_ids), len(ids) - 1)
+        return numpy.where(ids[positions] == uom_ids, positions + 1, missing)
+
+    def get_template_uom(self):
+        """
+        Return an array with the column of the reference uom of every product
+        template in the conversion table, indexed by the template id. Templates
+        that aren't exported, or have no known reference uom, get the last
+        column.
+        """
+        if self.template_uom is None:
+            size = max(self.product_templates, default=0) + 1
+            templates = numpy.zeros(size, dtype=int)
+            for id, tmpl in self.product_templates.items():
+                templates[id] = tmpl["uom_id"] or 0
+            self.template_uom = self.uom_positions(
+                templates, len(self.uom_matrix[0]) + 1
+            )
+        return self.template_uom
 
     def convert_float_time(self, float_time):
         """
@@ -291,7 +1033,7 @@ class exporter(object):
             m = self.env["hr.holidays.public.line"]
             recs = m.search([])
             fields = ["date"]
-            for i in recs.read(fields):
+            for i in self.read_records(recs, fields):
                 nd = datetime.strptime(i["date"], "%Y-%m-%d") + timedelta(days=1)
                 yield '<bucket start="%sT00:00:00" end="%sT00:00:00" value="0" priority="1"/>\n' % (
                     i["date"],
@@ -321,66 +1063,87 @@ class exporter(object):
         stock.warehouse.name -> location.name
         stock.warehouse.id -> location.subcategory
         """
-        self.map_locations = {}
         self.warehouses = set()
-        childlocs = {}
         m = self.env["stock.warehouse"]
         recs = m.search([])
         if recs:
             yield "<!-- warehouses -->\n"
             yield "<locations>\n"
-            fields = [
-                "name",
-                "lot_stock_id",
-                "wh_input_stock_loc_id",
-                "wh_output_stock_loc_id",
-                "wh_pack_stock_loc_id",
-                "wh_qc_stock_loc_id",
-                "view_location_id",
-            ]
-            for i in recs.read(fields):
+            for i in self.read_records(recs, ["name"]):
                 yield '<location name=%s subcategory="%s"><available name=%s/></location>\n' % (
                     quoteattr(i["name"]),
                     i["id"],
                     quoteattr(self.calendar),
                 )
-                childlocs[i["lot_stock_id"][0]] = i["name"]
-                childlocs[i["wh_input_stock_loc_id"][0]] = i["name"]
-                childlocs[i["wh_output_stock_loc_id"][0]] = i["name"]
-                childlocs[i["wh_pack_stock_loc_id"][0]] = i["name"]
-                childlocs[i["wh_qc_stock_loc_id"][0]] = i["name"]
-                childlocs[i["view_location_id"][0]] = i["name"]
-                # also add warehouse id for future lookups
-                childlocs[i["id"]] = i["name"]
-
                 self.warehouses.add(i["name"])
             yield "</locations>\n"
 
-            # Populate a mapping location-to-warehouse name for later lookups
-            parent_loc = {}
-            m = self.env["stock.location"]
-            recs = m.search([])
-            for i in recs.read(["location_id"]):
-                if i["location_id"]:
-                    parent_loc[i["id"]] = i["location_id"][0]
-
-            marked = {}
-
-            def fnd_parent(loc_id):  # go up the parent chain to find the warehouse
-                if not marked.get(loc_id):  # ensures O(N) iterations instead of O(N^2)
-                    if childlocs.get(loc_id):
-                        return childlocs[loc_id]
-                    if parent_loc.get(loc_id):
-                        parent = fnd_parent(parent_loc[loc_id])
-                        if parent:
-                            return parent
-                marked[loc_id] = True
-                return -1
-
-            for loc_id in recs:
-                parent = fnd_parent(loc_id["id"])
-                if parent:
-                    self.map_locations[loc_id["id"]] = parent
+        # Populate a mapping location-to-warehouse name for later lookups
+        self.load_locations()
+
+    def load_locations(self):
+        """
+        Build a map between the stock locations and the name of the warehouse
+        they belong to.
+
+        The warehouse of a location is found from the closest parent in its
+        parent_path that is one of the locations of a warehouse. This is done
+        for all locations in a single query, rather than walking up the parent
+        chain of every location.
+
+        The map is loaded only once per export. It is used by export_locations,
+        export_manufacturingorders and export_onhand.
+        """
+        if self.map_locations is None:
+            self.map_locations = self.cached(("locations",), self.read_locations)
+
+    def read_locations(self):
+        map_locations = {}
+        childlocs = {}
+        m = self.env["stock.warehouse"]
+        recs = m.search([])
+        fields = [
+            "name",
+            "lot_stock_id",
+            "wh_input_stock_loc_id",
+            "wh_output_stock_loc_id",
+            "wh_pack_stock_loc_id",
+            "wh_qc_stock_loc_id",
+            "view_location_id",
+        ]
+        for i in self.read_records(recs, fields):
+            childlocs[i["lot_stock_id"]] = i["name"]
+            childlocs[i["wh_input_stock_loc_id"]] = i["name"]
+            childlocs[i["wh_output_stock_loc_id"]] = i["name"]
+            childlocs[i["wh_pack_stock_loc_id"]] = i["name"]
+            childlocs[i["wh_qc_stock_loc_id"]] = i["name"]
+            childlocs[i["view_location_id"]] = i["name"]
+            # also add warehouse id for future lookups
+            childlocs[i["id"]] = i["name"]
+        childlocs.pop(False, None)
+        if not childlocs:
+            return map_locations
+        self.env.cr.execute(
+            "select id, warehouse_location from ("
+            "  select id, ("
+            "    select parent.id "
+            "    from unnest(string_to_array(rtrim(parent_path, '/'), '/')::integer[]) "
+            "      with ordinality as parent(id, depth) "
+            "    where parent.id = any(%s) "
+            "    order by parent.depth desc "
+            "    limit 1"
+            "    ) as warehouse_location "
+            "  from stock_location "
+            "  where active"
+            "  ) locations "
+            "where warehouse_location is not null",
+            (list(childlocs.keys()),),
+        )
+        rows = self.env.cr.fetchall()
+        self.rows_read += len(rows)
+        for i in rows:
+            map_locations[i[0]] = childlocs[i[1]]
+        return map_locations
 
     def export_customers(self):
         """
@@ -390,19 +1153,55 @@ class exporter(object):
         Mapping:
         res.partner.id res.partner.name -> customer.name
         """
-        self.map_customers = {}
-        m = self.env["res.partner"]
-        recs = m.search([("is_company", "=", True), ("customer_rank", ">", 0)])
-        if recs:
+        self.load_customers()
+        delta = self.watermarks.get("customers", None)
+        if self.map_customers or delta:
+            m = self.env["res.partner"]
+            domain = [("is_company", "=", True), ("customer_rank", ">", 0)]
+            if delta:
+                changed = set(m.search(self.delta_domain("customers", domain)).ids)
+            else:
+                changed = None
             yield "<!-- customers -->\n"
             yield "<customers>\n"
-            fields = ["name"]
-            for i in recs.read(fields):
-                name = "%d %s" % (i["id"], i["name"])
-                yield "<customer name=%s/>\n" % quoteattr(name)
-                self.map_customers[i["id"]] = name
+            for i in self.export_deletions("customers", "customer"):
+                yield i
+            for id, name in self.map_customers.items():
+                if changed is None or id in changed:
+                    yield "<customer name=%s/>\n" % quoteattr(name)
+            # Delta mode: remove the customers that were archived
+            if delta:
+                for i in self.export_archived("customers", m, domain):
+                    yield '<customer name=%s action="R"/>\n' % quoteattr(
+                        "%d %s" % (i["id"], i["name"])
+                    )
             yield "</customers>\n"
 
+    def load_customers(self):
+        """
+        Load the map of the customers, unless it is already loaded.
+        """
+        if self.map_customers is not None:
+            return
+        m = self.env["res.partner"]
+        domain = [("is_company", "=", True), ("customer_rank", ">", 0)]
+
+        # The customer map is cached. Partners change too often to invalidate
+        # the cache on every update. The map is cached with a fingerprint of
+        # the customers instead: any change to them changes the fingerprint.
+        self.env.cr.execute(
+            "select count(*), max(write_date) from res_partner "
+            "where is_company and customer_rank > 0 and active"
+        )
+        self.map_customers = self.cached(
+            ("customers",),
+            lambda: {
+                i["id"]: "%d %s" % (i["id"], i["name"])
+                for i in self.read_records(m.search(domain), ["name"])
+            },
+            tuple(self.env.cr.fetchone()),
+        )
+
     def export_suppliers(self):
         """
         Generate a list of suppliers for frePPLe, based on the res.partner model.
@@ -412,15 +1211,25 @@ class exporter(object):
         res.partner.id res.partner.name -> supplier.name
         """
         m = self.env["res.partner"]
-        recs = m.search([("is_company", "=", True), ("supplier_rank", ">", 0)])
-        if recs:
+        domain = [("is_company", "=", True), ("supplier_rank", ">", 0)]
+        recs = m.search(self.delta_domain("suppliers", domain))
+        delta = self.watermarks.get("suppliers", None)
+        if recs or delta:
             yield "<!-- suppliers -->\n"
             yield "<suppliers>\n"
+            for i in self.export_deletions("suppliers", "supplier"):
+                yield i
             fields = ["name"]
-            for i in recs.read(fields):
+            for i in self.read_records(recs, fields):
                 yield "<supplier name=%s/>\n" % quoteattr(
                     "%d %s" % (i["id"], i["name"])
                 )
+            # Delta mode: remove the suppliers that were archived
+            if delta:
+                for i in self.export_archived("suppliers", m, domain):
+                    yield '<supplier name=%s action="R"/>\n' % quoteattr(
+                        "%d %s" % (i["id"], i["name"])
+                    )
             yield "</suppliers>\n"
 
     def export_skills(self):
@@ -430,7 +1239,7 @@ class exporter(object):
         if recs:
             yield "<!-- skills -->\n"
             yield "<skills>\n"
-            for i in recs.read(fields):
+            for i in self.read_records(recs, fields):
                 name = i["name"]
                 yield "<skill name=%s/>\n" % (quoteattr(name),)
             yield "</skills>\n"
@@ -442,12 +1251,17 @@ class exporter(object):
         if recs:
             yield "<!-- resourceskills -->\n"
             yield "<skills>\n"
-            for i in recs.read(fields):
-                yield "<skill name=%s>\n" % quoteattr(i["skill"][1])
+            rows = self.read_records(recs, fields)
+            skills = self.load_names("mrp.skill", [i["skill"] for i in rows])
+            workcenters = self.load_names(
+                "mrp.workcenter", [i["workcenter"] for i in rows]
+            )
+            for i in rows:
+                yield "<skill name=%s>\n" % quoteattr(skills[i["skill"]])
                 yield "<resourceskills>"
                 yield '<resourceskill priority="%d"><resource name=%s/></resourceskill>' % (
                     i["priority"],
-                    quoteattr(i["workcenter"][1]),
+                    quoteattr(workcenters[i["workcenter"]]),
                 )
                 yield "</resourceskills>"
                 yield "</skill>"
@@ -472,7 +1286,9 @@ class exporter(object):
         if recs:
             yield "<!-- workcenters -->\n"
             yield "<resources>\n"
-            for i in recs.read(fields):
+            rows = self.read_records(recs, fields)
+            owners = self.load_names("mrp.workcenter", [i["owner"] for i in rows])
+            for i in rows:
                 name = i["name"]
                 owner = i["owner"]
                 logger.info(owner)
@@ -481,7 +1297,7 @@ class exporter(object):
                     quoteattr(name),
                     1,
                     quoteattr(self.mfg_location),
-                    ("<owner name=%s/>" % quoteattr(owner[1])) if owner else "",
+                    ("<owner name=%s/>" % quoteattr(owners[owner])) if owner else "",
                 )
             yield "</resources>\n"
 
@@ -507,33 +1323,20 @@ class exporter(object):
         product.product.product_tmpl_id.delay -> itemsupplier.leadtime
         '1' -> itemsupplier.priority
         """
-        # Read the product templates
-        self.product_product = {}
-        self.product_template_product = {}
-        self.category_parent = {}
-
-        m = self.env["product.category"]
-        fields = ["name", "parent_id"]
-        recs = m.search([])
-        for i in recs.read(fields):
-            if i["parent_id"]:
-                self.category_parent[i["name"]] = i["parent_id"]
-        m = self.env["product.template"]
-        fields = [
-            "purchase_ok",
-            # "route_ids", #does not exist anymore in odoo 12
-            # "bom_ids",  #does not exist anymore in odoo 12
-            "produce_delay",
-            "list_price",
-            "uom_id",
-            # "seller_ids",  #does not exist anymore in odoo 12
-            # "standard_price",  #does not exist anymore in odoo 12
-            "categ_id",
-        ]
-        recs = m.search([("type", "!=", "service")])
-        self.product_templates = {}
-        for i in recs.read(fields):
-            self.product_templates[i["id"]] = i
+        # Read the product templates and products
+        products = self.read_products()
+
+        # The category of an item is the complete name of the product category,
+        # which includes the names of its parent categories.
+        self.category_names = self.cached(
+            ("categories",),
+            lambda: {
+                i["id"]: i["complete_name"]
+                for i in self.read_records(
+                    self.env["product.category"].search([]), ["complete_name"]
+                )
+            },
+        )
 
         # Read the stock location routes
         # rts = self.env["stock.location.route"]
@@ -551,43 +1354,75 @@ class exporter(object):
         )
         supplier_id = {}
         fields = ["id", "name"]
-        for i in recs.read(fields):
+        for i in self.read_records(recs, fields):
             supplier_id[i["id"]] = i["name"]
 
-        # Read the products
-        m = self.env["product.product"]
-        recs = m.search([])
-        s = self.env["product.supplierinfo"]
-        s_fields = ["name", "delay", "min_qty", "date_end", "date_start", "price"]
-        if recs:
+        # Read the supplier info of all purchasable templates at once, rather
+        # than querying it for every product.
+        # The search applies the default order of the model, and that order is
+        # preserved within each template.
+        supplierinfo = {}
+        m = self.env["product.supplierinfo"]
+        recs = m.search(
+            [
+                (
+                    "product_tmpl_id",
+                    "in",
+                    [i for i, j in self.product_templates.items() if j["purchase_ok"]],
+                )
+            ]
+        )
+        fields = [
+            "name",
+            "delay",
+            "min_qty",
+            "date_end",
+            "date_start",
+            "price",
+            "product_tmpl_id",
+            "write_date",
+            "create_date",
+        ]
+        changed_templates = set()
+        rows = self.read_records(recs, fields)
+        supplier_names = self.load_names(
+            "res.partner", [i["name"] for i in rows], "display_name"
+        )
+        for i in rows:
+            supplierinfo.setdefault(i["product_tmpl_id"], []).append(i)
+            if self.is_changed("items", i):
+                changed_templates.add(i["product_tmpl_id"])
+
+        # Export the products
+        if products:
             yield "<!-- products -->\n"
             yield "<items>\n"
-            fields = ["id", "name", "code", "product_tmpl_id"]  # , "seller_ids"]
-            for i in recs.read(fields):
-                tmpl = self.product_templates[i["product_tmpl_id"][0]]
-                if i["code"]:
-                    name = u"[%s] %s" % (i["code"], i["name"])
-                else:
-                    name = i["name"]
-                prod_obj = {"name": name, "template": i["product_tmpl_id"][0]}
-                self.product_product[i["id"]] = prod_obj
-                self.product_template_product[i["product_tmpl_id"][0]] = prod_obj
+            for i in self.export_deletions("items", "item"):
+                yield i
+            # The cost is per unit of the reference uom
+            units = self.convert_qty_uom_batch(
+                [1.0] * len(products),
+                [
+                    self.product_templates[i["product_tmpl_id"]]["uom_id"]
+                    for i in products
+                ],
+                [i["product_tmpl_id"] for i in products],
+            )
+            for i, unit in zip(products, units):
+                tmpl = self.product_templates[i["product_tmpl_id"]]
+                name = self.product_product[i["id"]]["name"]
+                if not (
+                    self.is_changed("items", i)
+                    or self.is_changed("items", tmpl)
+                    or tmpl["id"] in changed_templates
+                ):
+                    # Delta mode: unchanged item
+                    continue
                 yield '<item name=%s cost="%f" category=%s subcategory="%s,%s">\n' % (
                     quoteattr(name),
-                    (tmpl["list_price"] or 0)
-                    / self.convert_qty_uom(
-                        1.0, tmpl["uom_id"][0], i["product_tmpl_id"][0]
-                    ),
-                    quoteattr(
-                        "%s%s"
-                        % (
-                            ("%s/" % self.category_parent(tmpl["categ_id"][1]))
-                            if tmpl["categ_id"][1] in self.category_parent
-                            else "",
-                            tmpl["categ_id"][1],
-                        )
-                    ),
-                    self.uom_categories[self.uom[tmpl["uom_id"][0]]["category"]],
+                    (tmpl["list_price"] or 0) / unit,
+                    quoteattr(self.category_names[tmpl["categ_id"]]),
+                    self.uom_categories[self.uom[tmpl["uom_id"]]["category"]],
                     i["id"],
                 )
                 # Export suppliers for the item, if the item is allowed to be purchased
@@ -597,10 +1432,8 @@ class exporter(object):
                     # and tmpl["seller_ids"] seller_ids doesn't exist anymore in odoo 12
                 ):
                     yield "<itemsuppliers>\n"
-                    for sup in s.search([("product_tmpl_id", "=", tmpl["id"])]).read(
-                        s_fields
-                    ):
-                        name = "%d %s" % (sup["name"][0], sup["name"][1])
+                    for sup in supplierinfo.get(tmpl["id"], []):
+                        name = "%d %s" % (sup["name"], supplier_names[sup["name"]])
                         yield '<itemsupplier leadtime="P%dD" priority="1" size_minimum="%f" cost="%f"%s%s><supplier name=%s/></itemsupplier>\n' % (
                             sup["delay"],
                             sup["min_qty"],
@@ -617,33 +1450,125 @@ class exporter(object):
                         )
                     yield "</itemsuppliers>\n"
                 yield "</item>\n"
+
+            # Delta mode: remove the items that were archived
+            if self.watermarks.get("items", None):
+                m = self.env["product.product"]
+                for i in self.export_archived("items", m, [], ("name", "code")):
+                    yield '<item name=%s action="R"/>\n' % quoteattr(
+                        (u"[%s] %s" % (i["code"], i["name"]))
+                        if i["code"]
+                        else i["name"]
+                    )
             yield "</items>\n"
 
-    def export_boms(self):
+    def load_products(self):
         """
-        Exports mrp.routings, mrp.routing.workcenter and mrp.bom records into
-        frePPLe operations, flows and loads.
-
-        Not supported yet: a) parent boms, b) phantom boms.
+        Load the maps of the products, unless the items section already built
+        them. Sections exported without the items section call this first.
         """
-        yield "<!-- bills of material -->\n"
-        yield "<operations>\n"
-        self.operations = set()
-
-        # dictionary used to divide the confirmed MO quantities
-        # key is tuple (operation name, produced item)
-        # value is quantity in Operation Materials.
-        self.bom_producedQty = {}
+        if self.product_product is None:
+            # The maps are cached with a fingerprint of the products, so the
+            # pages of a paginated export don't read all products again.
+            (
+                self.product_templates,
+                self.product_product,
+                self.product_template_product,
+            ) = self.cached(
+                ("products",),
+                self.read_product_maps,
+                self.table_fingerprint(["product.template", "product.product"]),
+            )
+            self.template_uom = None
+
+    def read_product_maps(self):
+        self.read_products()
+        return (
+            self.product_templates,
+            self.product_product,
+            self.product_template_product,
+        )
 
-        # Read all active manufacturing routings
-        mrp_routings = {}
-        # m = self.env["mrp.routing"]
-        # recs = m.search([])
-        # fields = ["location_id"]
-        # for i in recs.read(fields):
-        #    mrp_routings[i["id"]] = i["location_id"]
+    def read_products(self):
+        """
+        Read the product templates and the products, and build the maps of the
+        products the other sections look up. Returns the products read.
+        """
+        m = self.env["product.template"]
+        fields = [
+            "purchase_ok",
+            # "route_ids", #does not exist anymore in odoo 12
+            # "bom_ids",  #does not exist anymore in odoo 12
+            "produce_delay",
+            "list_price",
+            "uom_id",
+            # "seller_ids",  #does not exist anymore in odoo 12
+            # "standard_price",  #does not exist anymore in odoo 12
+            "categ_id",
+            "write_date",
+            "create_date",
+        ]
+        recs = m.search([("type", "!=", "service")])
+        self.product_templates = {}
+        self.template_uom = None
+        for i in self.read_records(recs, fields):
+            self.product_templates[i["id"]] = i
+
+        m = self.env["product.product"]
+        fields = [
+            "id",
+            "name",
+            "code",
+            "product_tmpl_id",
+            "write_date",
+            "create_date",
+        ]  # , "seller_ids"]
+        products = self.read_records(m.search([]), fields)
+        self.product_product = {}
+        self.product_template_product = {}
+        for i in products:
+            if i["code"]:
+                name = u"[%s] %s" % (i["code"], i["name"])
+            else:
+                name = i["name"]
+            prod_obj = {"name": name, "template": i["product_tmpl_id"]}
+            self.product_product[i["id"]] = prod_obj
+            self.product_template_product[i["product_tmpl_id"]] = prod_obj
+        return products
+
+    def load_boms(self):
+        """
+        Load the operations of the bills of material and their produced
+        quantities, unless the boms section already built them.
+
+        Only the boms and the routing steps are read for this. The flows and
+        loads of the operations aren't built.
+        """
+        if self.operations is None:
+            self.load_products()
+            # The maps are cached with a fingerprint of the boms, the routing
+            # steps and the products, so the pages of a paginated export don't
+            # read all boms again.
+            self.operations, self.bom_producedQty = self.cached(
+                ("boms", self.mfg_location, self.manage_work_orders),
+                lambda: self.build_boms(
+                    self.read_boms(), self.read_routing_workcenters()
+                ),
+                self.table_fingerprint(
+                    [
+                        "mrp.bom",
+                        "mrp.routing.workcenter",
+                        "product.template",
+                        "product.product",
+                    ]
+                ),
+            )
 
-        # Read all workcenters of all routings
+    def read_routing_workcenters(self):
+        """
+        Read the steps of all routings, indexed by routing. A step is a list
+        [workcenter, time, sequence, name, skill, search mode].
+        """
         mrp_routing_workcenters = {}
         m = self.env["mrp.routing.workcenter"]
         recs = m.search([], order="routing_id, sequence asc")
@@ -656,271 +1581,358 @@ class exporter(object):
             "skill",
             "search_mode",
         ]
-        for i in recs.read(fields):
-            if i["routing_id"][0] in mrp_routing_workcenters:
+        rows = self.read_records(recs, fields)
+        workcenters = self.load_names(
+            "mrp.workcenter", [i["workcenter_id"] for i in rows]
+        )
+        skills = self.load_names("mrp.skill", [i["skill"] for i in rows])
+        for i in rows:
+            if i["routing_id"] in mrp_routing_workcenters:
                 # If the same workcenter is used multiple times in a routing,
                 # we add the times together.
                 exists = False
                 if not self.manage_work_orders:
-                    for r in mrp_routing_workcenters[i["routing_id"][0]]:
-                        if r[0] == i["workcenter_id"][1]:
+                    for r in mrp_routing_workcenters[i["routing_id"]]:
+                        if r[0] == workcenters[i["workcenter_id"]]:
                             r[1] += i["time_cycle"]
                             exists = True
                             break
                 if not exists:
-                    mrp_routing_workcenters[i["routing_id"][0]].append(
+                    mrp_routing_workcenters[i["routing_id"]].append(
                         [
-                            i["workcenter_id"][1],
+                            workcenters[i["workcenter_id"]],
                             i["time_cycle"],
                             i["sequence"],
                             i["name"],
-                            i["skill"][1] if i["skill"] else None,
+                            skills[i["skill"]] if i["skill"] else None,
                             i["search_mode"],
                         ]
                     )
             else:
-                mrp_routing_workcenters[i["routing_id"][0]] = [
+                mrp_routing_workcenters[i["routing_id"]] = [
                     [
-                        i["workcenter_id"][1],
+                        workcenters[i["workcenter_id"]],
                         i["time_cycle"],
                         i["sequence"],
                         i["name"],
-                        i["skill"][1] if i["skill"] else None,
+                        skills[i["skill"]] if i["skill"] else None,
                         i["search_mode"],
                     ]
                 ]
+        return mrp_routing_workcenters
 
-        # Models used in the bom-loop below
-        bom_lines_model = self.env["mrp.bom.line"]
-        bom_lines_fields = ["product_qty", "product_uom_id", "product_id", "routing_id"]
-        try:
-            subproduct_model = self.env["mrp.subproduct"]
-            subproduct_fields = [
-                "product_id",
-                "product_qty",
-                "product_uom",
-                "subproduct_type",
-            ]
-        except Exception:
-            subproduct_model = None
-
-        # Loop over all bom records
-        bom_recs = self.env["mrp.bom"].search([])
-        bom_fields = [
+    def read_boms(self):
+        """
+        Read all boms, with their uom factor and their produced quantity in the
+        reference uom of the item.
+        """
+        fields = [
             "product_qty",
             "product_uom_id",
             "product_tmpl_id",
             "routing_id",
             "type",
-            "bom_line_ids",
+            "write_date",
+            "create_date",
         ]
-        for i in bom_recs.read(bom_fields):
-            # Determine the location
-            if i["routing_id"]:
-                location = mrp_routings.get(i["routing_id"][0], None)
-                if not location:
-                    location = self.mfg_location
-                else:
-                    location = location[1]
-            else:
-                location = self.mfg_location
+        boms = self.read_records(self.env["mrp.bom"].search([]), fields)
+        uom_factors = self.convert_qty_uom_batch(
+            [1.0] * len(boms),
+            [i["product_uom_id"] for i in boms],
+            [i["product_tmpl_id"] for i in boms],
+        )
+        quantities = self.convert_qty_uom_batch(
+            [i["product_qty"] for i in boms],
+            [i["product_uom_id"] for i in boms],
+            [i["product_tmpl_id"] for i in boms],
+        )
+        for i, uom_factor, qty in zip(boms, uom_factors, quantities):
+            i["uom_factor"] = uom_factor
+            i["quantity"] = qty
+        return boms
 
-            # Determine operation name and item
-            product_buf = self.product_template_product.get(
-                i["product_tmpl_id"][0], None
-            )  # TODO avoid multiple bom on single template
-            if not product_buf:
+    def bom_operation(self, i):
+        """
+        Return the operation name, the item and the location of a bom, or None
+        when its item isn't exported.
+        """
+        # Determine the location
+        # The location of the routing isn't used yet:
+        # m = self.env["mrp.routing"]
+        # recs = m.search([])
+        # fields = ["location_id"]
+        # for i in recs.read(fields):
+        #    mrp_routings[i["id"]] = i["location_id"]
+        location = self.mfg_location
+
+        # Determine operation name and item
+        product_buf = self.product_template_product.get(
+            i["product_tmpl_id"], None
+        )  # TODO avoid multiple bom on single template
+        if not product_buf:
+            return None
+        operation = u"%d %s @ %s" % (i["id"], product_buf["name"], location)
+        return operation, product_buf, location
+
+    def bom_steps(self, i, mrp_routing_workcenters):
+        """
+        Return the routing steps a bom is exported with as suboperations, or
+        None when all steps are collapsed in a single operation.
+        """
+        if not self.manage_work_orders or not i["routing_id"]:
+            return None
+        return mrp_routing_workcenters.get(i["routing_id"], []) or None
+
+    def build_boms(self, boms, mrp_routing_workcenters):
+        """
+        Build the set of the operations of the boms, and the quantity the
+        operations produce.
+
+        The produced quantities are used to divide the confirmed MO quantities.
+        The key is the tuple (operation name, produced item) and the value is
+        the quantity in the operation materials.
+        """
+        operations = set()
+        bom_producedQty = {}
+        for i in boms:
+            bom = self.bom_operation(i)
+            if not bom:
                 logger.warning(
-                    "skipping %s %s" % (i["product_tmpl_id"][0], i["routing_id"])
+                    "skipping %s %s" % (i["product_tmpl_id"], i["routing_id"])
                 )
                 continue
-            uom_factor = self.convert_qty_uom(
-                1.0, i["product_uom_id"][0], i["product_tmpl_id"][0]
+            operation, product_buf, location = bom
+            operations.add(operation)
+            steplist = self.bom_steps(i, mrp_routing_workcenters)
+            if not steplist:
+                bom_producedQty[(operation, product_buf["name"])] = i["quantity"]
+                continue
+            # sequence cannot be trusted in odoo12
+            for counter, step in enumerate(steplist, 1):
+                if step[2] == steplist[-1][2]:
+                    # The last routing step produces the item
+                    bom_producedQty[
+                        (
+                            "%s - %s - %s" % (operation, step[3], (counter * 100)),
+                            product_buf["name"],
+                        )
+                    ] = (
+                        i["product_qty"]
+                        * getattr(i, "product_efficiency", 1.0)
+                        * i["uom_factor"]
+                    )
+        return operations, bom_producedQty
+
+    def export_boms(self):
+        """
+        Exports mrp.routings, mrp.routing.workcenter and mrp.bom records into
+        frePPLe operations, flows and loads.
+
+        Not supported yet: a) parent boms, b) phantom boms.
+        """
+        self.load_products()
+        yield "<!-- bills of material -->\n"
+        yield "<operations>\n"
+        for i in self.export_deletions(
+            "boms", "operation", suffix=" @ %s" % self.mfg_location
+        ):
+            yield i
+
+        mrp_routing_workcenters = self.read_routing_workcenters()
+        boms = self.read_boms()
+        if self.operations is None:
+            self.operations, self.bom_producedQty = self.build_boms(
+                boms, mrp_routing_workcenters
             )
-            operation = u"%d %s @ %s" % (i["id"], product_buf["name"], location)
-            self.operations.add(operation)
-
-            # Build operation. The operation can either be a summary operation or a detailed
-            # routing.
-            if (
-                not self.manage_work_orders
-                or not i["routing_id"]
-                or not mrp_routing_workcenters.get(i["routing_id"][0], [])
+
+        # Read the lines of all boms in a single pass, and index them by bom.
+        # The search uses the default order of the model, which is also the
+        # order of the bom_line_ids field.
+        self.bom_lines = {}
+        m = self.env["mrp.bom.line"]
+        recs = m.search([("bom_id", "in", [i["id"] for i in boms])])
+        fields = [
+            "bom_id",
+            "product_qty",
+            "product_uom_id",
+            "product_id",
+            "routing_id",
+            "write_date",
+            "create_date",
+        ]
+        rows = self.read_records(recs, fields)
+        quantities = self.convert_qty_uom_batch(
+            [i["product_qty"] for i in rows],
+            [i["product_uom_id"] for i in rows],
+            [
+                self.product_product.get(i["product_id"], {}).get("template", 0)
+                for i in rows
+            ],
+        )
+        for i, qty in zip(rows, quantities):
+            # Quantity in the reference uom of the component
+            i["quantity"] = qty
+            self.bom_lines.setdefault(i["bom_id"], []).append(i)
+
+        # Loop over all bom records. In delta mode, only the operations of the
+        # changed boms are sent.
+        for i in boms:
+            if not self.is_changed("boms", i) and not any(
+                self.is_changed("boms", j) for j in self.bom_lines.get(i["id"], [])
             ):
-                #
-                # CASE 1: A single operation used for the BOM
-                # All routing steps are collapsed in a single operation.
-                #
-                yield '<operation name=%s size_multiple="1" duration="%s" posttime="P%dD" xsi:type="operation_fixed_time">\n' "<item name=%s/><location name=%s/>\n" % (
-                    quoteattr(operation),
-                    self.convert_float_time(
-                        self.product_templates[i["product_tmpl_id"][0]]["produce_delay"]
-                    ),
-                    self.manufacturing_lead,
-                    quoteattr(product_buf["name"]),
-                    quoteattr(location),
-                )
-                convertedQty = self.convert_qty_uom(
-                    i["product_qty"], i["product_uom_id"][0], i["product_tmpl_id"][0]
-                )
-                yield '<flows>\n<flow xsi:type="flow_end" quantity="%f"><item name=%s/></flow>\n' % (
-                    convertedQty,
-                    quoteattr(product_buf["name"]),
+                continue
+            bom = self.bom_operation(i)
+            if bom:
+                for j in self.export_bom(i, *bom, mrp_routing_workcenters):
+                    yield j
+
+        # Delta mode: remove the operations of archived boms
+        if self.watermarks.get("boms", None):
+            m = self.env["mrp.bom"]
+            for i in self.export_archived("boms", m, [], ("product_tmpl_id",)):
+                product_buf = self.product_template_product.get(
+                    i["product_tmpl_id"], None
                 )
-                self.bom_producedQty[(operation, product_buf["name"])] = convertedQty
-
-                # Build consuming flows.
-                # If the same component is consumed multiple times in the same BOM
-                # we sum up all quantities in a single flow. We assume all of them
-                # have the same effectivity.
-                fl = {}
-                for j in bom_lines_model.browse(i["bom_line_ids"]).read(
-                    bom_lines_fields
+                if product_buf:
+                    yield '<operation name=%s action="R"/>\n' % quoteattr(
+                        u"%d %s @ %s" % (i["id"], product_buf["name"], self.mfg_location)
+                    )
+        yield "</operations>\n"
+
+    def export_bom(self, i, operation, product_buf, location, mrp_routing_workcenters):
+        """
+        Generate the operation of a single bom.
+        """
+        # Build operation. The operation can either be a summary operation or a detailed
+        # routing.
+        steplist = self.bom_steps(i, mrp_routing_workcenters)
+        if not steplist:
+            #
+            # CASE 1: A single operation used for the BOM
+            # All routing steps are collapsed in a single operation.
+            #
+            yield '<operation name=%s size_multiple="1" duration="%s" posttime="P%dD" xsi:type="operation_fixed_time">\n' "<item name=%s/><location name=%s/>\n" % (
+                quoteattr(operation),
+                self.convert_float_time(
+                    self.product_templates[i["product_tmpl_id"]]["produce_delay"]
+                ),
+                self.manufacturing_lead,
+                quoteattr(product_buf["name"]),
+                quoteattr(location),
+            )
+            yield '<flows>\n<flow xsi:type="flow_end" quantity="%f"><item name=%s/></flow>\n' % (
+                i["quantity"],
+                quoteattr(product_buf["name"]),
+            )
+
+            # Build consuming flows.
+            for j in self.export_bom_components(i["id"]):
+                yield j
+
+            # Build byproduct flows
+            if i.get("sub_products", None) and "mrp.subproduct" in self.env:
+                for j in self.read_records(
+                    self.env["mrp.subproduct"].browse(i["sub_products"]),
+                    ["product_id", "product_qty", "product_uom", "subproduct_type"],
                 ):
-                    product = self.product_product.get(j["product_id"][0], None)
+                    product = self.product_product.get(j["product_id"], None)
                     if not product:
                         continue
-                    if j["product_id"][0] in fl:
-                        fl[j["product_id"][0]].append(j)
-                    else:
-                        fl[j["product_id"][0]] = [j]
-                for j in fl:
-                    product = self.product_product[j]
-                    qty = sum(
+                    yield '<flow xsi:type="%s" quantity="%f"><item name=%s/></flow>\n' % (
+                        "flow_fixed_end"
+                        if j["subproduct_type"] == "fixed"
+                        else "flow_end",
                         self.convert_qty_uom(
-                            k["product_qty"],
-                            k["product_uom_id"][0],
-                            self.product_product[k["product_id"][0]]["template"],
-                        )
-                        for k in fl[j]
-                    )
-                    yield '<flow xsi:type="flow_start" quantity="-%f"><item name=%s/></flow>\n' % (
-                        qty,
+                            j["product_qty"], j["product_uom"], j["product_id"],
+                        ),
                         quoteattr(product["name"]),
                     )
+            yield "</flows>\n"
 
-                # Build byproduct flows
-                if i.get("sub_products", None) and subproduct_model:
-                    for j in subproduct_model.browse(i["sub_products"]).read(
-                        subproduct_fields
-                    ):
-                        product = self.product_product.get(j["product_id"][0], None)
-                        if not product:
-                            continue
-                        yield '<flow xsi:type="%s" quantity="%f"><item name=%s/></flow>\n' % (
-                            "flow_fixed_end"
-                            if j["subproduct_type"] == "fixed"
-                            else "flow_end",
-                            self.convert_qty_uom(
-                                j["product_qty"],
-                                j["product_uom"][0],
-                                j["product_id"][0],
-                            ),
-                            quoteattr(product["name"]),
-                        )
-                yield "</flows>\n"
-
-                # Create loads
-                if i["routing_id"]:
-                    yield "<loads>\n"
-                    for j in mrp_routing_workcenters.get(i["routing_id"][0], []):
-                        yield '<load quantity="%f" search=%s><resource name=%s/>%s</load>\n' % (
-                            j[1],
-                            quoteattr(j[5]),
-                            quoteattr(j[0]),
-                            ("<skill name=%s/>" % quoteattr(j[4])) if j[4] else "",
-                        )
-                    yield "</loads>\n"
-            else:
-                #
-                # CASE 2: A routing operation is created with a suboperation for each
-                # routing step.
-                #
-                yield '<operation name=%s size_multiple="1" posttime="P%dD" xsi:type="operation_routing">' "<item name=%s/><location name=%s/>\n" % (
-                    quoteattr(operation),
-                    self.manufacturing_lead,
-                    quoteattr(product_buf["name"]),
+            # Create loads
+            if i["routing_id"]:
+                yield "<loads>\n"
+                for j in mrp_routing_workcenters.get(i["routing_id"], []):
+                    yield '<load quantity="%f" search=%s><resource name=%s/>%s</load>\n' % (
+                        j[1],
+                        quoteattr(j[5]),
+                        quoteattr(j[0]),
+                        ("<skill name=%s/>" % quoteattr(j[4])) if j[4] else "",
+                    )
+                yield "</loads>\n"
+        else:
+            #
+            # CASE 2: A routing operation is created with a suboperation for each
+            # routing step.
+            #
+            yield '<operation name=%s size_multiple="1" posttime="P%dD" xsi:type="operation_routing">' "<item name=%s/><location name=%s/>\n" % (
+                quoteattr(operation),
+                self.manufacturing_lead,
+                quoteattr(product_buf["name"]),
+                quoteattr(location),
+            )
+
+            yield "<suboperations>"
+            # sequence cannot be trusted in odoo12
+            counter = 0
+            for step in steplist:
+                counter = counter + 1
+                suboperation = step[3]
+                yield "<suboperation>" '<operation name=%s priority="%s" duration="%s" xsi:type="operation_fixed_time">\n' "<location name=%s/>\n" '<loads><load quantity="%f" search=%s><resource name=%s/>%s</load></loads>\n' % (
+                    quoteattr(
+                        "%s - %s - %s" % (operation, suboperation, (counter * 100))
+                    ),
+                    counter * 10,
+                    self.convert_float_time(step[1]),
                     quoteattr(location),
+                    1,
+                    quoteattr(step[5]),
+                    quoteattr(step[0]),
+                    ("<skill name=%s/>" % quoteattr(step[4])) if step[4] else "",
                 )
-
-                yield "<suboperations>"
-                steplist = mrp_routing_workcenters[i["routing_id"][0]]
-                # sequence cannot be trusted in odoo12
-                counter = 0
-                for step in steplist:
-                    counter = counter + 1
-                    suboperation = step[3]
-                    yield "<suboperation>" '<operation name=%s priority="%s" duration="%s" xsi:type="operation_fixed_time">\n' "<location name=%s/>\n" '<loads><load quantity="%f" search=%s><resource name=%s/>%s</load></loads>\n' % (
-                        quoteattr(
-                            "%s - %s - %s" % (operation, suboperation, (counter * 100))
-                        ),
-                        counter * 10,
-                        self.convert_float_time(step[1]),
-                        quoteattr(location),
-                        1,
-                        quoteattr(step[5]),
-                        quoteattr(step[0]),
-                        ("<skill name=%s/>" % quoteattr(step[4])) if step[4] else "",
+                if step[2] == steplist[-1][2]:
+                    # Add producing flows on the last routing step
+                    yield '<flows>\n<flow xsi:type="flow_end" quantity="%f"><item name=%s/></flow>\n' % (
+                        i["product_qty"]
+                        * getattr(i, "product_efficiency", 1.0)
+                        * i["uom_factor"],
+                        quoteattr(product_buf["name"]),
                     )
-                    if step[2] == steplist[-1][2]:
-                        # Add producing flows on the last routing step
-                        yield '<flows>\n<flow xsi:type="flow_end" quantity="%f"><item name=%s/></flow>\n' % (
-                            i["product_qty"]
-                            * getattr(i, "product_efficiency", 1.0)
-                            * uom_factor,
-                            quoteattr(product_buf["name"]),
-                        )
+                    yield "</flows>\n"
+                if step[2] == steplist[0][2]:
+                    # All consuming flows on the first routing step.
+                    yield "<flows>\n"
+                    for j in self.export_bom_components(i["id"]):
+                        yield j
+                    yield "</flows>\n"
+                yield "</operation></suboperation>\n"
+            yield "</suboperations>\n"
+        yield "</operation>\n"
+
+    def export_bom_components(self, bom_id):
+        """
+        Generate the consuming flows of a bom, from the index of bom lines
+        built in export_boms.
 
-                        yield "</flows>\n"
-                        self.bom_producedQty[
-                            (
-                                "%s - %s - %s"
-                                % (operation, suboperation, (counter * 100)),
-                                product_buf["name"],
-                            )
-                        ] = (
-                            i["product_qty"]
-                            * getattr(i, "product_efficiency", 1.0)
-                            * uom_factor
-                        )
-                    if step[2] == steplist[0][2]:
-                        # All consuming flows on the first routing step.
-                        # If the same component is consumed multiple times in the same BOM
-                        # we sum up all quantities in a single flow. We assume all of them
-                        # have the same effectivity.
-                        fl = {}
-                        for j in bom_lines_model.browse(i["bom_line_ids"]).read(
-                            bom_lines_fields
-                        ):
-                            product = self.product_product.get(j["product_id"][0], None)
-                            if not product:
-                                continue
-                            if j["product_id"][0] in fl:
-                                fl[j["product_id"][0]].append(j)
-                            else:
-                                fl[j["product_id"][0]] = [j]
-                        yield "<flows>\n"
-                        for j in fl:
-                            product = self.product_product[j]
-                            qty = sum(
-                                self.convert_qty_uom(
-                                    k["product_qty"],
-                                    k["product_uom_id"][0],
-                                    self.product_product[k["product_id"][0]][
-                                        "template"
-                                    ],
-                                )
-                                for k in fl[j]
-                            )
-                            yield '<flow xsi:type="flow_start" quantity="-%f"><item name=%s/></flow>\n' % (
-                                qty,
-                                quoteattr(product["name"]),
-                            )
-                        yield "</flows>\n"
-                    yield "</operation></suboperation>\n"
-                yield "</suboperations>\n"
-            yield "</operation>\n"
-        yield "</operations>\n"
+        If the same component is consumed multiple times in the same BOM
+        we sum up all quantities in a single flow. We assume all of them
+        have the same effectivity.
+        """
+        fl = {}
+        for j in self.bom_lines.get(bom_id, []):
+            if j["product_id"] not in self.product_product:
+                continue
+            if j["product_id"] in fl:
+                fl[j["product_id"]].append(j)
+            else:
+                fl[j["product_id"]] = [j]
+        for j in fl:
+            product = self.product_product[j]
+            qty = sum(k["quantity"] for k in fl[j])
+            yield '<flow xsi:type="flow_start" quantity="-%f"><item name=%s/></flow>\n' % (
+                qty,
+                quoteattr(product["name"]),
+            )
 
     def export_salesorders(self):
         """
@@ -949,9 +1961,131 @@ class exporter(object):
         stock.warehouse.name -> demand->location
         (if sale.order.picking_policy = 'one' then same as demand.quantity else 1) -> demand.minshipment
         """
+        self.load_products()
+        self.load_customers()
+
+        # Generate the demand records
+        yield "<!-- sales order lines -->\n"
+        yield "<demands>\n"
+        for i in self.export_deletions("salesorders", "demand"):
+            yield i
+
+        if self.sql_salesorders:
+            so_line = self.read_salesorders_sql()
+        else:
+            so_line = self.read_salesorders()
+        for batch in self.split_batches(so_line):
+            demands = []
+            quantities = []
+            for i, j in batch:
+                name = u"%s %d" % (j["name"], i["id"])
+                product = self.product_product.get(i["product_id"], None)
+                location = j["warehouse"]
+                customer = self.map_customers.get(j["partner_id"], None)
+                if not customer or not location or not product:
+                    # Not interested in this sales order...
+                    continue
+                due = j.get("requested_date", False) or j["date_order"]
+                priority = 1  # We give all customer orders the same default priority
+
+                # Possible sales order status are 'draft', 'sent', 'sale', 'done' and 'cancel'
+                state = j.get("state", "sale")
+                if state == "draft":
+                    status = "quote"
+                    qty = i["product_uom_qty"]
+                elif state == "sale":
+                    qty = i["product_uom_qty"] - i["qty_delivered"]
+                    if qty <= 0:
+                        status = "closed"
+                        qty = i["product_uom_qty"]
+                    else:
+                        status = "open"
+                elif state in ("done", "sent"):
+                    status = "closed"
+                    qty = i["product_uom_qty"]
+                elif state == "cancel":
+                    status = "canceled"
+                    qty = i["product_uom_qty"]
+
+                #           pick = self.req.session.model('stock.picking')
+                #           p_fields = ['move_lines', 'sale_id', 'state']
+                #           move = self.req.session.model('stock.move')
+                #           m_fields = ['product_id', 'product_uom_qty']
+                #           if j['picking_ids']:
+                #                 # The code below only works in specific situations.
+                #                 # If activated incorrectly it can lead to duplicate demands.
+                #                 # Here to export sale order line based that is closed by stock moves.
+                #                 # if DO line is done then demand status is closed
+                #                 # if DO line is cancel, it will skip the current DO line
+                #                 # else demand status is open
+                #                 pick_number = 0
+                #                 for p in pick.read(j['picking_ids'], p_fields, self.req.session.context):
+                #                     p_ids = p['move_lines']
+                #                     product_id = i['product_id'][0]
+                #                     mv_ids = move.search([('id', 'in', p_ids), ('product_id','=', product_id)], context=self.req.session.context)
+                #
+                #                     status = ''
+                #                     if p['state'] == 'done':
+                #                         if self.mode in (1, 3):
+                #                           # Closed orders aren't transferred during a small run of mode 1
+                #                           continue
+                #                         status = 'closed'
+                #                     elif p['state'] == 'cancel':
+                #                         continue
+                #                     else:
+                #                         status = 'open'
+                #
+                #                     for mv in move.read(mv_ids, m_fields, self.req.session.context):
+                #                         logger.error("     C sales order line %s  %s " % (i, mv))
+                #                         pick_number = pick_number + 1
+                #                         name = u'%s %d %d' % (i['order_id'][1], i['id'], pick_number)
+                #                         yield '<demand name=%s quantity="%s" due="%s" priority="%s" minshipment="%s" status="%s"><item name=%s/><customer name=%s/><location name=%s/></demand>\n' % (
+                #                             quoteattr(name), mv['product_uom_qty'], due.strftime("%Y-%m-%dT%H:%M:%S")
+                #                             priority, minship,status, quoteattr(product['name']),
+                #                             quoteattr(customer), quoteattr(location)
+                #                         )
+                demands.append(
+                    (i, j, name, product, location, customer, due, priority, status)
+                )
+                quantities.append(qty)
+
+            # Convert the quantities of the batch at once
+            quantities = self.convert_qty_uom_batch(
+                quantities,
+                [d[0]["product_uom"] for d in demands],
+                [d[3]["template"] for d in demands],
+            )
+            for (
+                (i, j, name, product, location, customer, due, priority, status),
+                qty,
+            ) in zip(demands, quantities):
+                yield '<demand name=%s quantity="%s" due="%s" priority="%s" minshipment="%s" status="%s"><item name=%s/><customer name=%s/><location name=%s/></demand>\n' % (
+                    quoteattr(name),
+                    qty,
+                    due.strftime("%Y-%m-%dT%H:%M:%S"),
+                    priority,
+                    j["picking_policy"] == "one" and qty or 1.0,
+                    status,
+                    quoteattr(product["name"]),
+                    quoteattr(customer),
+                    quoteattr(location),
+                )
+
+        yield "</demands>\n"
+
+    def read_salesorders(self):
+        """
+        Read the sales order lines with the ORM.
+        Yields pairs of a sales order line and its sales order.
+        """
         # Get all sales order lines
-        m = self.env["sale.order.line"]
-        recs = m.search([("product_id", "!=", False)])
+        recs = self.search_page(
+            "salesorders",
+            "sale.order.line",
+            self.delta_domain(
+                "salesorders", [("product_id", "!=", False)], ("order_id",)
+            ),
+        )
         fields = [
             "qty_delivered",
             "state",
@@ -960,12 +2094,9 @@ class exporter(object):
             "product_uom",
             "order_id",
         ]
-        so_line = [i for i in recs.read(fields)]
-
-        # Get all sales orders
         m = self.env["sale.order"]
-        ids = [i["order_id"][0] for i in so_line]
-        fields = [
+        so_fields = [
+            "name",
             "state",
             "partner_id",
             "requested_date",
@@ -973,116 +2104,86 @@ class exporter(object):
             "picking_policy",
             "warehouse_id",
         ]
-        so = {}
-        for i in m.browse(ids).read(fields):
-            so[i["id"]] = i
+        for so_line in self.read_batches(recs, fields):
+            # Get the sales orders of the batch
+            ids = list(set(i["order_id"] for i in so_line))
+            so = {}
+            for i in self.read_records(m.browse(ids), so_fields):
+                so[i["id"]] = i
+            warehouses = self.load_names(
+                "stock.warehouse", [i["warehouse_id"] for i in so.values()]
+            )
+            for i in so.values():
+                i["warehouse"] = warehouses.get(i["warehouse_id"], None)
 
-        # Generate the demand records
-        yield "<!-- sales order lines -->\n"
-        yield "<demands>\n"
+            for i in so_line:
+                yield i, so[i["order_id"]]
 
-        for i in so_line:
-            name = u"%s %d" % (i["order_id"][1], i["id"])
-            product = self.product_product.get(i["product_id"][0], None)
-            j = so[i["order_id"][0]]
-            location = j["warehouse_id"][1]
-            customer = self.map_customers.get(j["partner_id"][0], None)
-            if not customer or not location or not product:
-                # Not interested in this sales order...
-                continue
-            due = j.get("requested_date", False) or j["date_order"]
-            priority = 1  # We give all customer orders the same default priority
-
-            # Possible sales order status are 'draft', 'sent', 'sale', 'done' and 'cancel'
-            state = j.get("state", "sale")
-            if state == "draft":
-                status = "quote"
-                qty = self.convert_qty_uom(
-                    i["product_uom_qty"],
-                    i["product_uom"][0],
-                    self.product_product[i["product_id"][0]]["template"],
-                )
-            elif state == "sale":
-                qty = i["product_uom_qty"] - i["qty_delivered"]
-                if qty <= 0:
-                    status = "closed"
-                    qty = self.convert_qty_uom(
-                        i["product_uom_qty"],
-                        i["product_uom"][0],
-                        self.product_product[i["product_id"][0]]["template"],
-                    )
-                else:
-                    status = "open"
-                    qty = self.convert_qty_uom(
-                        qty,
-                        i["product_uom"][0],
-                        self.product_product[i["product_id"][0]]["template"],
-                    )
-            elif state in ("done", "sent"):
-                status = "closed"
-                qty = self.convert_qty_uom(
-                    i["product_uom_qty"],
-                    i["product_uom"][0],
-                    self.product_product[i["product_id"][0]]["template"],
-                )
-            elif state == "cancel":
-                status = "canceled"
-                qty = self.convert_qty_uom(
-                    i["product_uom_qty"],
-                    i["product_uom"][0],
-                    self.product_product[i["product_id"][0]]["template"],
-                )
+    def read_salesorders_sql(self):
+        """
+        Read the sales order lines with a single SQL query, bypassing the ORM
+        for performance reasons.
+        Yields pairs of a sales order line and its sales order, with the same
+        fields as read_salesorders.
 
-            #           pick = self.req.session.model('stock.picking')
-            #           p_fields = ['move_lines', 'sale_id', 'state']
-            #           move = self.req.session.model('stock.move')
-            #           m_fields = ['product_id', 'product_uom_qty']
-            #           if j['picking_ids']:
-            #                 # The code below only works in specific situations.
-            #                 # If activated incorrectly it can lead to duplicate demands.
-            #                 # Here to export sale order line based that is closed by stock moves.
-            #                 # if DO line is done then demand status is closed
-            #                 # if DO line is cancel, it will skip the current DO line
-            #                 # else demand status is open
-            #                 pick_number = 0
-            #                 for p in pick.read(j['picking_ids'], p_fields, self.req.session.context):
-            #                     p_ids = p['move_lines']
-            #                     product_id = i['product_id'][0]
-            #                     mv_ids = move.search([('id', 'in', p_ids), ('product_id','=', product_id)], context=self.req.session.context)
-            #
-            #                     status = ''
-            #                     if p['state'] == 'done':
-            #                         if self.mode == 1:
-            #                           # Closed orders aren't transferred during a small run of mode 1
-            #                           continue
-            #                         status = 'closed'
-            #                     elif p['state'] == 'cancel':
-            #                         continue
-            #                     else:
-            #                         status = 'open'
-            #
-            #                     for mv in move.read(mv_ids, m_fields, self.req.session.context):
-            #                         logger.error("     C sales order line %s  %s " % (i, mv))
-            #                         pick_number = pick_number + 1
-            #                         name = u'%s %d %d' % (i['order_id'][1], i['id'], pick_number)
-            #                         yield '<demand name=%s quantity="%s" due="%s" priority="%s" minshipment="%s" status="%s"><item name=%s/><customer name=%s/><location name=%s/></demand>\n' % (
-            #                             quoteattr(name), mv['product_uom_qty'], due.strftime("%Y-%m-%dT%H:%M:%S")
-            #                             priority, minship,status, quoteattr(product['name']),
-            #                             quoteattr(customer), quoteattr(location)
-            #                         )
-            yield '<demand name=%s quantity="%s" due="%s" priority="%s" minshipment="%s" status="%s"><item name=%s/><customer name=%s/><location name=%s/></demand>\n' % (
-                quoteattr(name),
-                qty,
-                due.strftime("%Y-%m-%dT%H:%M:%S"),
-                priority,
-                j["picking_policy"] == "one" and qty or 1.0,
-                status,
-                quoteattr(product["name"]),
-                quoteattr(customer),
-                quoteattr(location),
+        Like export_onhand, this query doesn't apply the record rules.
+        """
+        has_requested_date = "requested_date" in self.env["sale.order"]._fields
+        query = (
+            "select sale_order_line.id, sale_order_line.product_id, "
+            "sale_order_line.product_uom_qty, sale_order_line.qty_delivered, "
+            "sale_order_line.product_uom, sale_order.name, sale_order.state, "
+            "sale_order.partner_id, sale_order.date_order, "
+            "sale_order.picking_policy, stock_warehouse.name, %s "
+            "from sale_order_line "
+            "inner join sale_order "
+            "on sale_order.id = sale_order_line.order_id "
+            "left outer join stock_warehouse "
+            "on stock_warehouse.id = sale_order.warehouse_id "
+            "where sale_order_line.product_id is not null "
+            % ("sale_order.requested_date" if has_requested_date else "null")
+        )
+        params = []
+        since = self.watermarks.get("salesorders", None)
+        if since:
+            query += (
+                "and (sale_order_line.write_date > %s "
+                "or sale_order_line.create_date > %s "
+                "or sale_order.write_date > %s "
+                "or sale_order.create_date > %s) "
+            )
+            params = [since] * 4
+        if self.page is None:
+            query += (
+                "order by sale_order_line.order_id, sale_order_line.sequence, "
+                "sale_order_line.id"
+            )
+        else:
+            query += "and sale_order_line.id > %s order by sale_order_line.id limit %s"
+            params += [self.page.get("key", 0), self.page_size]
+        count = 0
+        for i in self.stream_query(query, params):
+            count += 1
+            if count == self.page_size:
+                self.page_last = i[0]
+            yield (
+                {
+                    "id": i[0],
+                    "product_id": i[1],
+                    "product_uom_qty": i[2],
+                    "qty_delivered": i[3],
+                    "product_uom": i[4],
+                },
+                {
+                    "name": i[5],
+                    "state": i[6],
+                    "partner_id": i[7],
+                    "date_order": i[8],
+                    "picking_policy": i[9],
+                    "warehouse": i[10],
+                    "requested_date": i[11],
+                },
             )
-
-        yield "</demands>\n"
 
     def export_purchaseorders(self):
         """
@@ -1102,18 +2203,30 @@ class exporter(object):
         'PO' -> operationplan.ordertype
         'confirmed' -> operationplan.status
         """
-        m = self.env["purchase.order.line"]
-        recs = m.search(
-            [
-                "|",
-                (
-                    "order_id.state",
-                    "not in",
-                    ("draft", "sent", "bid", "confirmed", "cancel"),
-                ),
-                ("order_id.state", "=", False),
-            ]
-        )
+        self.load_products()
+        delta = self.watermarks.get("purchaseorders", None)
+        if delta:
+            # Delta mode: all changed lines are read, and the ones that are no
+            # longer open are removed in frePPLe.
+            recs = self.search_page(
+                "purchaseorders",
+                "purchase.order.line",
+                self.delta_domain("purchaseorders", [], ("order_id",)),
+            )
+        else:
+            recs = self.search_page(
+                "purchaseorders",
+                "purchase.order.line",
+                [
+                    "|",
+                    (
+                        "order_id.state",
+                        "not in",
+                        ("draft", "sent", "bid", "confirmed", "cancel"),
+                    ),
+                    ("order_id.state", "=", False),
+                ],
+            )
         fields = [
             "name",
             "date_planned",
@@ -1124,46 +2237,69 @@ class exporter(object):
             "order_id",
             "state",
         ]
-        po_line = [i for i in recs.read(fields)]
-
-        # Get all purchase orders
         m = self.env["purchase.order"]
-        ids = [i["order_id"][0] for i in po_line]
-        fields = ["name", "company_id", "partner_id", "state", "date_order"]
-        po = {}
-        for i in m.browse(ids).read(fields):
-            po[i["id"]] = i
+        po_fields = ["name", "company_id", "partner_id", "state", "date_order"]
 
         # Create purchasing operations
         yield "<!-- open purchase orders -->\n"
         yield "<operationplans>\n"
-        for i in po_line:
-            if not i["product_id"] or i["state"] == "cancel":
-                continue
-            item = self.product_product.get(i["product_id"][0], None)
-            j = po[i["order_id"][0]]
-            # if PO status is done, we should ignore this PO line
-            if j["state"] == "done":
-                continue
-            location = self.mfg_location
-            if location and item and i["product_qty"] > i["qty_received"]:
-                start = j["date_order"].strftime("%Y-%m-%dT%H:%M:%S")
-                end = i["date_planned"].strftime("%Y-%m-%dT%H:%M:%S")
-                qty = self.convert_qty_uom(
-                    i["product_qty"] - i["qty_received"],
-                    i["product_uom"][0],
-                    self.product_product[i["product_id"][0]]["template"],
-                )
-                yield '<operationplan reference=%s ordertype="PO" start="%s" end="%s" quantity="%f" status="confirmed">' "<item name=%s/><location name=%s/><supplier name=%s/>" % (
-                    quoteattr("%s - %s" % (j["name"], i["id"])),
-                    start,
-                    end,
-                    qty,
-                    quoteattr(item["name"]),
-                    quoteattr(location),
-                    quoteattr("%d %s" % (j["partner_id"][0], j["partner_id"][1])),
-                )
-                yield "</operationplan>\n"
+        for i in self.export_deletions(
+            "purchaseorders", "operationplan", key="reference"
+        ):
+            yield i
+        for po_line in self.read_batches(recs, fields):
+            # Get the purchase orders of the batch
+            ids = list(set(i["order_id"] for i in po_line))
+            po = {}
+            for i in self.read_records(m.browse(ids), po_fields):
+                po[i["id"]] = i
+            suppliers = self.load_names(
+                "res.partner", [i["partner_id"] for i in po.values()], "display_name"
+            )
+            quantities = self.convert_qty_uom_batch(
+                [i["product_qty"] - i["qty_received"] for i in po_line],
+                [i["product_uom"] for i in po_line],
+                [
+                    self.product_product.get(i["product_id"], {}).get("template", 0)
+                    for i in po_line
+                ],
+            )
+            for i, qty in zip(po_line, quantities):
+                if not i["product_id"]:
+                    continue
+                item = self.product_product.get(i["product_id"], None)
+                j = po[i["order_id"]]
+                if delta and j["state"] in ("draft", "sent", "bid", "confirmed"):
+                    # Not exported yet
+                    continue
+                # Cancelled, done and fully received lines aren't open any longer
+                if (
+                    i["state"] == "cancel"
+                    or j["state"] in ("done", "cancel")
+                    or not item
+                    or i["product_qty"] <= i["qty_received"]
+                ):
+                    if delta:
+                        yield '<operationplan reference=%s action="R"/>\n' % quoteattr(
+                            "%s - %s" % (j["name"], i["id"])
+                        )
+                    continue
+                location = self.mfg_location
+                if location:
+                    start = j["date_order"].strftime("%Y-%m-%dT%H:%M:%S")
+                    end = i["date_planned"].strftime("%Y-%m-%dT%H:%M:%S")
+                    yield '<operationplan reference=%s ordertype="PO" start="%s" end="%s" quantity="%f" status="confirmed">' "<item name=%s/><location name=%s/><supplier name=%s/>" % (
+                        quoteattr("%s - %s" % (j["name"], i["id"])),
+                        start,
+                        end,
+                        qty,
+                        quoteattr(item["name"]),
+                        quoteattr(location),
+                        quoteattr(
+                            "%d %s" % (j["partner_id"], suppliers[j["partner_id"]])
+                        ),
+                    )
+                    yield "</operationplan>\n"
         yield "</operationplans>\n"
 
     def export_manufacturingorders(self):
@@ -1181,8 +2317,28 @@ class exporter(object):
         """
         yield "<!-- manufacturing orders in progress -->\n"
         yield "<operationplans>\n"
-        m = self.env["mrp.production"]
-        recs = m.search([("state", "in", ["confirmed", "planned", "progress"])])
+        for i in self.export_deletions(
+            "manufacturingorders", "operationplan", key="reference"
+        ):
+            yield i
+        self.load_locations()
+        self.load_products()
+        self.load_boms()
+        delta = self.watermarks.get("manufacturingorders", None)
+        if delta:
+            # Delta mode: all changed orders are read, and the ones that are no
+            # longer in progress are removed in frePPLe.
+            recs = self.search_page(
+                "manufacturingorders",
+                "mrp.production",
+                self.delta_domain("manufacturingorders", [("state", "!=", "draft")]),
+            )
+        else:
+            recs = self.search_page(
+                "manufacturingorders",
+                "mrp.production",
+                [("state", "in", ["confirmed", "planned", "progress"])],
+            )
         fields = [
             "bom_id",
             "date_start",
@@ -1194,49 +2350,58 @@ class exporter(object):
             "location_dest_id",
             "product_id",
         ]
-        for i in recs.read(fields):
-            if i["bom_id"]:
-                # Open orders
-                location = self.map_locations.get(i["location_dest_id"][0], None)
-                item = (
-                    self.product_product[i["product_id"][0]]
-                    if i["product_id"][0] in self.product_product
-                    else None
-                )
-                if not item:
-                    continue
-                operation = u"%d %s @ %s" % (
-                    i["bom_id"][0],
-                    item["name"],
-                    i["location_dest_id"][1],
-                )
-                try:
-                    startdate = str(i["date_start"] or i["date_planned_start"]).replace(
-                        " ", "T"
+        for rows in self.read_batches(recs, fields):
+            locations = self.load_names(
+                "stock.location", [i["location_dest_id"] for i in rows], "complete_name"
+            )
+            quantities = self.convert_qty_uom_batch(
+                [i["product_qty"] for i in rows],
+                [i["product_uom_id"] for i in rows],
+                [
+                    self.product_product.get(i["product_id"], {}).get("template", 0)
+                    for i in rows
+                ],
+            )
+            for i, qty in zip(rows, quantities):
+                if i["state"] not in ("confirmed", "planned", "progress"):
+                    yield '<operationplan reference=%s action="R"/>\n' % quoteattr(
+                        i["name"]
                     )
-                except Exception:
-                    continue
-                if not location or operation not in self.operations:
-                    continue
-                factor = (
-                    self.bom_producedQty[(operation, item["name"])]
-                    if (operation, i["name"]) in self.bom_producedQty
-                    else 1
-                )
-                qty = (
-                    self.convert_qty_uom(
-                        i["product_qty"],
-                        i["product_uom_id"][0],
-                        self.product_product[i["product_id"][0]]["template"],
+                elif i["bom_id"]:
+                    # Open orders
+                    location = self.map_locations.get(i["location_dest_id"], None)
+                    item = (
+                        self.product_product[i["product_id"]]
+                        if i["product_id"] in self.product_product
+                        else None
+                    )
+                    if not item:
+                        continue
+                    operation = u"%d %s @ %s" % (
+                        i["bom_id"],
+                        item["name"],
+                        locations[i["location_dest_id"]],
+                    )
+                    try:
+                        startdate = str(
+                            i["date_start"] or i["date_planned_start"]
+                        ).replace(" ", "T")
+                    except Exception:
+                        continue
+                    if not location or operation not in self.operations:
+                        continue
+                    factor = (
+                        self.bom_producedQty[(operation, item["name"])]
+                        if (operation, i["name"]) in self.bom_producedQty
+                        else 1
+                    )
+                    qty = qty / factor
+                    yield '<operationplan type="MO" reference=%s start="%s" quantity="%s" status="confirmed"><operation name=%s/></operationplan>\n' % (
+                        quoteattr(i["name"]),
+                        startdate,
+                        qty,
+                        quoteattr(operation),
                     )
-                    / factor
-                )
-                yield '<operationplan type="MO" reference=%s start="%s" quantity="%s" status="confirmed"><operation name=%s/></operationplan>\n' % (
-                    quoteattr(i["name"]),
-                    startdate,
-                    qty,
-                    quoteattr(operation),
-                )
         yield "</operationplans>\n"
 
     def export_orderpoints(self):
@@ -1252,8 +2417,12 @@ class exporter(object):
         convert stock.warehouse.orderpoint.product_max_qty -> buffer.maxinventory
         convert stock.warehouse.orderpoint.qty_multiple -> buffer->size_multiple
         """
-        m = self.env["stock.warehouse.orderpoint"]
-        recs = m.search([])
+        self.load_products()
+        recs = self.search_page(
+            "orderpoints",
+            "stock.warehouse.orderpoint",
+            self.delta_domain("orderpoints", []),
+        )
         fields = [
             "warehouse_id",
             "product_id",
@@ -1262,38 +2431,64 @@ class exporter(object):
             "product_uom",
             "qty_multiple",
         ]
-        if recs:
+        delta = self.watermarks.get("orderpoints", None)
+        if recs or delta:
             yield "<!-- order points -->\n"
             yield "<buffers>\n"
-            for i in recs.read(fields):
-                item = self.product_product.get(
-                    i["product_id"] and i["product_id"][0] or 0, None
+            for i in self.export_deletions("orderpoints", "buffer"):
+                yield i
+            for rows in self.read_batches(recs, fields):
+                warehouses = self.load_names(
+                    "stock.warehouse", [i["warehouse_id"] for i in rows]
                 )
-                if not item:
-                    continue
-                uom_factor = self.convert_qty_uom(
-                    1.0,
-                    i["product_uom"][0],
-                    self.product_product[i["product_id"][0]]["template"],
+                uom_factors = self.convert_qty_uom_batch(
+                    [1.0] * len(rows),
+                    [i["product_uom"] for i in rows],
+                    [
+                        self.product_product.get(i["product_id"], {}).get(
+                            "template", 0
+                        )
+                        for i in rows
+                    ],
                 )
-                name = u"%s @ %s" % (item["name"], i["warehouse_id"][1])
-                yield "<buffer name=%s><item name=%s/><location name=%s/>\n" '%s%s%s<booleanproperty name="ip_flag" value="true"/>\n' '<stringproperty name="roq_type" value="quantity"/>\n<stringproperty name="ss_type" value="quantity"/>\n' "</buffer>\n" % (
-                    quoteattr(name),
-                    quoteattr(item["name"]),
-                    quoteattr(i["warehouse_id"][1]),
-                    '<doubleproperty name="ss_min_qty" value="%s"/>\n'
-                    % (i["product_min_qty"] * uom_factor)
-                    if i["product_min_qty"]
-                    else "",
-                    '<doubleproperty name="roq_min_qty" value="%s"/>\n'
-                    % ((i["product_max_qty"] - i["product_min_qty"]) * uom_factor)
-                    if (i["product_max_qty"] - i["product_min_qty"])
-                    else "",
-                    '<doubleproperty name="roq_multiple_qty" value="%s"/>\n'
-                    % (i["qty_multiple"] * uom_factor)
-                    if i["qty_multiple"]
-                    else "",
+                for i, uom_factor in zip(rows, uom_factors):
+                    item = self.product_product.get(i["product_id"] or 0, None)
+                    if not item:
+                        continue
+                    name = u"%s @ %s" % (item["name"], warehouses[i["warehouse_id"]])
+                    yield "<buffer name=%s><item name=%s/><location name=%s/>\n" '%s%s%s<booleanproperty name="ip_flag" value="true"/>\n' '<stringproperty name="roq_type" value="quantity"/>\n<stringproperty name="ss_type" value="quantity"/>\n' "</buffer>\n" % (
+                        quoteattr(name),
+                        quoteattr(item["name"]),
+                        quoteattr(warehouses[i["warehouse_id"]]),
+                        '<doubleproperty name="ss_min_qty" value="%s"/>\n'
+                        % (i["product_min_qty"] * uom_factor)
+                        if i["product_min_qty"]
+                        else "",
+                        '<doubleproperty name="roq_min_qty" value="%s"/>\n'
+                        % ((i["product_max_qty"] - i["product_min_qty"]) * uom_factor)
+                        if (i["product_max_qty"] - i["product_min_qty"])
+                        else "",
+                        '<doubleproperty name="roq_multiple_qty" value="%s"/>\n'
+                        % (i["qty_multiple"] * uom_factor)
+                        if i["qty_multiple"]
+                        else "",
+                    )
+            # Delta mode: remove the buffers of the order points that were
+            # archived
+            if delta:
+                m = self.env["stock.warehouse.orderpoint"]
+                rows = self.export_archived(
+                    "orderpoints", m, [], ("product_id", "warehouse_id")
                 )
+                warehouses = self.load_names(
+                    "stock.warehouse", [i["warehouse_id"] for i in rows]
+                )
+                for i in rows:
+                    item = self.product_product.get(i["product_id"] or 0, None)
+                    if item and i["warehouse_id"]:
+                        yield '<buffer name=%s action="R"/>\n' % quoteattr(
+                            u"%s @ %s" % (item["name"], warehouses[i["warehouse_id"]])
+                        )
             yield "</buffers>\n"
 
     def export_onhand(self):
@@ -1308,6 +2503,8 @@ class exporter(object):
         stock.report.prodlots.location_id.name -> buffer.location
         sum(stock.report.prodlots.qty) -> buffer.onhand
         """
+        self.load_locations()
+        self.load_products()
         yield "<!-- inventory -->\n"
         yield "<buffers>\n"
         self.env.cr.execute(
@@ -1318,7 +2515,9 @@ class exporter(object):
             "ORDER BY location_id ASC"
         )
         inventory = {}
-        for i in self.env.cr.fetchall():
+        rows = self.env.cr.fetchall()
+        self.rows_read += len(rows)
+        for i in rows:
             item = self.product_product.get(i[0], None)
             location = self.map_locations.get(i[1], None)
             if item and location:
@@ -1334,3 +2533,49 @@ class exporter(object):
                 quoteattr(key[1]),
             )
         yield "</buffers>\n"
+
+
+class buffered(object):
+    """
+    Output layer between the exporter and the HTTP response.
+
+    The exporter yields many tiny strings, sometimes a single tag. Sending each
+    of them costs a write on the socket, and a call of the compressor. This
+    collects them into chunks of about the buffer size, and encodes every
+    chunk in one go. It iterates over utf-8 encoded chunks.
+
+    It counts the fragments received, and the chunks and bytes it produced.
+    """
+
+    def __init__(self, fragments, size=65536):
+        self.fragments = fragments
+        self.size = size
+        self.fragment_count = 0
+        self.chunk_count = 0
+        self.bytes = 0
+
+    def __iter__(self):
+        parts = []
+        length = 0
+        try:
+            for i in self.fragments:
+                self.fragment_count += 1
+                parts.append(i)
+                length += len(i)
+                if length >= self.size:
+                    yield self.flush(parts)
+                    parts = []
+                    length = 0
+        except Exception:
+            # Send what the exporter generated before the error
+            if parts:
+                yield self.flush(parts)
+            raise
+        if parts:
+            yield self.flush(parts)
+
+    def flush(self, parts):
+        chunk = "".join(parts).encode("utf-8")
+        self.chunk_count += 1
+        self.bytes += len(chunk)
+        return chunk
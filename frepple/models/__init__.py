@@ -1,3 +1,4 @@
+from . import frepple_cache
 from . import res_company
 from . import res_config_settings
 from . import mrp_skill
@@ -5,3 +6,13 @@ from . import stock_move_line
 from . import mrp_workcenter_inherit
 from . import mrp_routing_workcenter_inherit
 from . import mrp_workcenter_skill
+from . import frepple_watermark
+from . import frepple_snapshot
+from . import frepple_import_job
+from . import sale_order_line
+from . import purchase_order_line
+from . import mrp_production
+from . import product_product
+from . import mrp_bom
+from . import res_partner
+from . import stock_warehouse_orderpoint
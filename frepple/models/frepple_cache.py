@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from odoo import api, models, tools
+
+
+class Cache(models.AbstractModel):
+    _name = "frepple.cache"
+    _description = "Cache of the reference data exported to frePPLe"
+
+    def init(self):
+        # The generation of the cache, increased when the records of the
+        # frepple.cache.invalidation models change
+        self.env.cr.execute(
+            "create table if not exists frepple_cache_generation "
+            "(generation integer not null)"
+        )
+        self.env.cr.execute(
+            "insert into frepple_cache_generation select 0 "
+            "where not exists (select 1 from frepple_cache_generation)"
+        )
+
+    @api.model
+    def get(self, key, fingerprint, loader):
+        """
+        Return the value cached under the key, calling the loader to build it
+        when it isn't cached yet or was built for another fingerprint.
+
+        A single value is kept per key: a value built again replaces the
+        previous one. The fingerprint holds the generation of the cache and
+        anything else identifying the version of the records the value is built
+        from. The cached values are shared by all exports and must not be
+        modified. The key must include everything else the value depends on,
+        including the user and companies whose access rights it was read with.
+        """
+        entry = self.get_entry(key)
+        data = entry.get("data", None)
+        if data is None or data[0] != fingerprint:
+            data = (fingerprint, loader())
+            # Replaced at once, so other threads see a consistent pair
+            entry["data"] = data
+        return data[1]
+
+    @api.model
+    @tools.ormcache("key")
+    def get_entry(self, key):
+        """
+        Return the holder of the value cached under the key.
+
+        The holders live in the ormcache of the registry, which is per database
+        and per worker.
+        """
+        return {}
+
+    @api.model
+    def get_generation(self):
+        self.env.cr.execute("select generation from frepple_cache_generation")
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def invalidate(self):
+        """
+        Increase the generation of the cache. The cached values built for the
+        previous generation are built again on their next use, in every
+        worker. This is part of the transaction changing the records: an
+        export only sees the new generation along with the new records.
+        """
+        self.env.cr.execute(
+            "update frepple_cache_generation set generation = generation + 1"
+        )
+
+
+# Invalidating the cache updates a single row, so the transactions changing
+# these models wait for each other. It is only done for models that rarely
+# change. Data that changes often, like the customers, is cached with a
+# fingerprint of its records instead.
+
+
+class CacheInvalidation(models.AbstractModel):
+    _name = "frepple.cache.invalidation"
+    _description = "Invalidate the frePPLe cache when records are changed"
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super(CacheInvalidation, self).create(vals_list)
+        self.env["frepple.cache"].invalidate()
+        return records
+
+    def write(self, vals):
+        res = super(CacheInvalidation, self).write(vals)
+        self.env["frepple.cache"].invalidate()
+        return res
+
+    def unlink(self):
+        res = super(CacheInvalidation, self).unlink()
+        self.env["frepple.cache"].invalidate()
+        return res
+
+
+# The models the cached reference data is built from
+
+
+class Uom(models.Model):
+    _name = "uom.uom"
+    _inherit = ["uom.uom", "frepple.cache.invalidation"]
+
+
+class ProductCategory(models.Model):
+    _name = "product.category"
+    _inherit = ["product.category", "frepple.cache.invalidation"]
+
+
+class StockLocation(models.Model):
+    _name = "stock.location"
+    _inherit = ["stock.location", "frepple.cache.invalidation"]
+
+
+class StockWarehouse(models.Model):
+    _name = "stock.warehouse"
+    _inherit = ["stock.warehouse", "frepple.cache.invalidation"]
+
+
+class ResourceCalendar(models.Model):
+    _name = "resource.calendar"
+    _inherit = ["resource.calendar", "frepple.cache.invalidation"]
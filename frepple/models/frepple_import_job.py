@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+import os
+
+import odoo
+from odoo import api, models, fields, tools
+
+from odoo.addons.frepple.controllers.inbound import importer
+
+_logger = logging.getLogger(__name__)
+
+
+class ImportJob(models.Model):
+    _name = "frepple.import.job"
+    _description = "Plan received from frePPLe, imported in the background"
+    _order = "id desc"
+
+    company_id = fields.Many2one(
+        "res.company", "Company", required=True, ondelete="cascade"
+    )
+    user_id = fields.Many2one("res.users", "User", required=True, ondelete="cascade")
+    mode = fields.Integer("Import mode", required=True, default=1)
+    state = fields.Selection(
+        [
+            ("queued", "Queued"),
+            ("running", "Running"),
+            ("done", "Done"),
+            ("failed", "Failed"),
+        ],
+        "Status",
+        required=True,
+        default="queued",
+    )
+    date_start = fields.Datetime("Started at")
+    date_end = fields.Datetime("Finished at")
+    count_po = fields.Integer("Procurement orders processed")
+    count_mo = fields.Integer("Manufacturing orders processed")
+    errors = fields.Text("Errors")
+    message = fields.Text("Message")
+
+    @api.model
+    def get_path(self, job_id):
+        """
+        Location of the uploaded plan of a job in the filestore of the database.
+        """
+        return os.path.join(
+            tools.config.filestore(self.env.cr.dbname),
+            "frepple",
+            "imports",
+            "%d.xml" % job_id,
+        )
+
+    def get_status(self):
+        """
+        Progress of the job, as reported by the status endpoint.
+        """
+        self.ensure_one()
+        if self.date_start:
+            end = self.date_end or fields.Datetime.now()
+            elapsed = round((end - self.date_start).total_seconds(), 1)
+        else:
+            elapsed = 0
+        return {
+            "job": self.id,
+            "state": self.state,
+            "processed": {"PO": self.count_po, "MO": self.count_mo},
+            "errors": self.errors.split("\n") if self.errors else [],
+            "elapsed": elapsed,
+            "message": self.message or "",
+        }
+
+    @api.model
+    def process_jobs(self):
+        """
+        Scheduled job importing the queued plans, oldest first.
+
+        A worker running an import longer than limit_time_real_cron, or
+        limit_time_real when that isn't set, is killed and leaves its job
+        running. Odoo never runs the same scheduled job twice at the same time,
+        so a job still running when this starts belongs to a killed worker: it
+        is marked failed. The time limit must exceed the longest import.
+        """
+        for job in self.search([("state", "=", "running")]):
+            _logger.error("Import of frePPLe plan of job %s was interrupted" % job.id)
+            job.write(
+                {
+                    "state": "failed",
+                    "date_end": fields.Datetime.now(),
+                    "message": "The import was interrupted, check the time limit "
+                    "of the scheduled jobs in the Odoo configuration",
+                }
+            )
+            path = self.get_path(job.id)
+            if os.path.exists(path):
+                os.remove(path)
+        self.env.cr.commit()
+        for job in self.search([("state", "=", "queued")], order="id"):
+            self.process_job(job)
+
+    @api.model
+    def process_job(self, job):
+        """
+        Import the plan of a job as the user who uploaded it.
+
+        The importer commits while removing the previous proposals, so the
+        state of the job is committed as well. Its progress is written through
+        a separate cursor, so it is visible while the import is still running.
+        """
+        job.write({"state": "running", "date_start": fields.Datetime.now()})
+        self.env.cr.commit()
+        path = self.get_path(job.id)
+        try:
+            with open(path, "rb") as datafile:
+                im = importer(
+                    None,
+                    database=self.env.cr.dbname,
+                    company=job.company_id,
+                    mode=job.mode,
+                    env=self.with_user(job.user_id).env,
+                    datafile=datafile,
+                )
+                im.progress = lambda po, mo, errors: self.report_progress(
+                    job.id, po, mo, errors
+                )
+                msg = im.run()
+            self.env.cr.commit()
+            job.write(
+                {
+                    "state": "done",
+                    "date_end": fields.Datetime.now(),
+                    "message": msg,
+                    "errors": "\n".join(im.errors),
+                }
+            )
+            self.env.cr.commit()
+        except Exception as e:
+            _logger.exception("Error importing frePPLe plan of job %s" % job.id)
+            self.env.cr.rollback()
+            self.env.clear()
+            job.write(
+                {"state": "failed", "date_end": fields.Datetime.now(), "message": str(e)}
+            )
+            self.env.cr.commit()
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    @api.model
+    def report_progress(self, job_id, count_po, count_mo, errors):
+        with odoo.registry(self.env.cr.dbname).cursor() as cr:
+            cr.execute(
+                """
+                update frepple_import_job
+                set count_po = %s, count_mo = %s, errors = %s
+                where id = %s
+                """,
+                (count_po, count_mo, "\n".join(errors), job_id),
+            )
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import gzip
+import logging
+import os
+
+from odoo import api, models, fields, tools
+
+from odoo.addons.frepple.controllers.outbound import buffered, exporter
+
+_logger = logging.getLogger(__name__)
+
+
+class Snapshot(models.Model):
+    _name = "frepple.snapshot"
+    _description = "Export of the data for frePPLe, generated in advance"
+
+    company_id = fields.Many2one(
+        "res.company", "Company", required=True, ondelete="cascade"
+    )
+    mode = fields.Integer("Export mode", required=True)
+    user_id = fields.Many2one("res.users", "Generated as", ondelete="cascade")
+    date = fields.Datetime("Generated at", required=True)
+    size = fields.Integer("Compressed size")
+
+    _sql_constraints = [
+        (
+            "company_mode_uniq",
+            "unique(company_id, mode)",
+            "Only one snapshot per company and mode is allowed",
+        )
+    ]
+
+    @api.model
+    def get_path(self, company_id, mode):
+        """
+        Location of a snapshot in the filestore of the database.
+        """
+        return os.path.join(
+            tools.config.filestore(self.env.cr.dbname),
+            "frepple",
+            str(company_id),
+            "mode%d.xml.gz" % mode,
+        )
+
+    @api.model
+    def generate_snapshots(self, modes=(1, 2)):
+        """
+        Scheduled job generating a snapshot of every export mode for every
+        company.
+
+        The delta mode isn't supported: its content depends on the watermarks
+        at the time it is requested.
+
+        The scheduled job runs as the superuser, which isn't subject to any
+        record rule. The export of a company is generated as its frePPLe user
+        instead, and only sent to that user. Companies without a frePPLe user
+        get no snapshots.
+        """
+        for company in self.env["res.company"].search([("frepple_user", "!=", False)]):
+            for mode in modes:
+                try:
+                    self.generate_snapshot(company, mode)
+                    self.env.cr.commit()
+                except Exception:
+                    _logger.exception(
+                        "Error generating frePPLe snapshot of mode %s for %s"
+                        % (mode, company.name)
+                    )
+                    self.env.cr.rollback()
+                    self.env.clear()
+
+    @api.model
+    def generate_snapshot(self, company, mode):
+        """
+        Export the data of a company to a compressed file in the filestore.
+
+        The data is written to a temporary file first, which then replaces the
+        previous snapshot. A snapshot being served is never overwritten halfway.
+        The watermarks aren't updated yet: that happens when the snapshot is
+        sent to frePPLe.
+        """
+        user = company.frepple_user
+        path = self.get_path(company.id, mode)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        xp = exporter(
+            None,
+            uid=user.id,
+            database=self.env.cr.dbname,
+            company=company.name,
+            mode=mode,
+            env=self.with_user(user).env,
+            acknowledge=False,
+        )
+        try:
+            with gzip.open(tmp, "wb", compresslevel=6) as f:
+                for i in buffered(xp.run()):
+                    f.write(i)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        vals = {
+            "date": xp.export_date,
+            "size": os.path.getsize(path),
+            "user_id": user.id,
+        }
+        snapshot = self.search(
+            [("company_id", "=", company.id), ("mode", "=", mode)], limit=1
+        )
+        if snapshot:
+            snapshot.write(vals)
+        else:
+            vals.update({"company_id": company.id, "mode": mode})
+            self.create(vals)
+        _logger.info(
+            "Generated frePPLe snapshot of mode %s for %s: %s bytes"
+            % (mode, company.name, vals["size"])
+        )
+
+    def acknowledge(self):
+        """
+        Record that the snapshots were sent to frePPLe.
+
+        A complete export moves the watermarks of its company to the time the
+        snapshot was generated. Changes after that are picked up by the next
+        delta export.
+        """
+        for i in self:
+            if i.mode == 1:
+                self.env["frepple.watermark"].sudo().update_watermarks(
+                    i.company_id.id, exporter.delta_sections, i.date
+                )
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+
+from odoo import api, models, fields
+
+_logger = logging.getLogger(__name__)
+
+
+class Watermark(models.Model):
+    _name = "frepple.watermark"
+    _description = "High-water mark of the data exported to frePPLe"
+
+    company_id = fields.Many2one(
+        "res.company", "Company", required=True, ondelete="cascade"
+    )
+    section = fields.Char("Section", required=True)
+    date = fields.Datetime("Exported until", required=True)
+
+    _sql_constraints = [
+        (
+            "company_section_uniq",
+            "unique(company_id, section)",
+            "Only one watermark per company and section is allowed",
+        )
+    ]
+
+    @api.model
+    def update_watermarks(self, company_id, sections, date):
+        """
+        Record that all changes of these sections until the date have been
+        completely sent to frePPLe.
+        """
+        recs = self.search([("company_id", "=", company_id)])
+        existing = {i.section: i for i in recs}
+        for section in sections:
+            if section in existing:
+                existing[section].write({"date": date})
+            else:
+                self.create({"company_id": company_id, "section": section, "date": date})
+
+        # The deletions older than all watermarks won't be exported any longer
+        self.env.cr.execute("select min(date) from frepple_watermark")
+        oldest = self.env.cr.fetchone()[0]
+        if oldest:
+            self.env["frepple.deletion"].search([("create_date", "<", oldest)]).unlink()
+
+
+class Deletion(models.Model):
+    _name = "frepple.deletion"
+    _description = "Log of the deleted records to remove from frePPLe"
+    _order = "id"
+
+    section = fields.Char("Section", required=True, index=True)
+    name = fields.Char("Name in frePPLe", required=True)
+    company_id = fields.Many2one("res.company", "Company", ondelete="cascade")
+
+    @api.model
+    def log_deletion(self, section, records, name):
+        """
+        Remember the frePPLe names of deleted records, such that the next delta
+        export can remove them from frePPLe as well.
+
+        The name function returns the frePPLe name of a record, or None when it
+        isn't exported. The deletion of a record of a company is only sent to
+        that company, and the one of a shared record to all companies. The
+        records the frePPLe importer removes were never sent to frePPLe, and
+        aren't logged: it sets the frepple_skip_deletions context key.
+        """
+        if self.env.context.get("frepple_skip_deletions", False):
+            return
+        vals = []
+        for i in records:
+            n = name(i)
+            if n:
+                vals.append(
+                    {"section": section, "name": n, "company_id": i.company_id.id}
+                )
+        self.sudo().create(vals)
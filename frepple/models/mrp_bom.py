@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from odoo import models
+
+
+class MrpBom(models.Model):
+    _inherit = "mrp.bom"
+
+    def unlink(self):
+        # Remember the operations to remove in the next delta export to frePPLe.
+        # The location is only known in the export, and is appended there.
+        # The export uses the last variant of the template as the item
+        variants = {}
+        for i in (
+            self.env["product.product"]
+            .search([("product_tmpl_id", "in", self.mapped("product_tmpl_id").ids)])
+            .read(["code", "name", "product_tmpl_id"], load=None)
+        ):
+            variants[i["product_tmpl_id"]] = (
+                ("[%s] %s" % (i["code"], i["name"])) if i["code"] else i["name"]
+            )
+        self.env["frepple.deletion"].log_deletion(
+            "boms",
+            self,
+            lambda i: "%d %s" % (i.id, variants[i.product_tmpl_id.id])
+            if i.product_tmpl_id.id in variants
+            else None,
+        )
+        return super(MrpBom, self).unlink()
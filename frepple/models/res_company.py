@@ -32,7 +32,7 @@ except Exception:
 
 class ResCompany(models.Model):
     _name = "res.company"
-    _inherit = "res.company"
+    _inherit = ["res.company", "frepple.cache.invalidation"]
 
     manufacturing_warehouse = fields.Many2one(
         "stock.warehouse", "Manufacturing warehouse", ondelete="set null"
@@ -40,6 +40,7 @@ class ResCompany(models.Model):
     calendar = fields.Many2one("resource.calendar", "Calendar", ondelete="set null")
     webtoken_key = fields.Char("Webtoken key", size=128)
     frepple_server = fields.Char("frePPLe web server", size=128)
+    frepple_user = fields.Many2one("res.users", "frePPLe user", ondelete="set null")
 
     @api.model
     def getFreppleURL(self, navbar=True, _url="/"):
@@ -37,3 +37,6 @@ class ResConfigSettings(models.TransientModel):
     frepple_server = fields.Char(
         "frePPLe server", size=128, related="company_id.frepple_server", readonly=False
     )
+    frepple_user = fields.Many2one(
+        "res.users", "frePPLe user", related="company_id.frepple_user", readonly=False
+    )
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from odoo import models
+
+
+class ResPartner(models.Model):
+    _inherit = "res.partner"
+
+    def unlink(self):
+        # Remember the customers and suppliers to remove in the next delta
+        # export to frePPLe
+        self.env["frepple.deletion"].log_deletion(
+            "customers",
+            self,
+            lambda i: "%d %s" % (i.id, i.name)
+            if i.is_company and i.customer_rank > 0
+            else None,
+        )
+        self.env["frepple.deletion"].log_deletion(
+            "suppliers",
+            self,
+            lambda i: "%d %s" % (i.id, i.name)
+            if i.is_company and i.supplier_rank > 0
+            else None,
+        )
+        return super(ResPartner, self).unlink()
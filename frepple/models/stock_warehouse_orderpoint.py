@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 by frePPLe bv
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from odoo import models
+
+
+class StockWarehouseOrderpoint(models.Model):
+    _inherit = "stock.warehouse.orderpoint"
+
+    def unlink(self):
+        # Remember the buffers to remove in the next delta export to frePPLe
+        self.env["frepple.deletion"].log_deletion(
+            "orderpoints",
+            self,
+            lambda i: "%s @ %s"
+            % (
+                ("[%s] %s" % (i.product_id.code, i.product_id.name))
+                if i.product_id.code
+                else i.product_id.name,
+                i.warehouse_id.name,
+            )
+            if i.product_id and i.warehouse_id
+            else None,
+        )
+        return super(StockWarehouseOrderpoint, self).unlink()